@@ -0,0 +1,35 @@
+import os
+import sys
+import time
+
+sys.path.append(".")
+
+from benchmark.synthetic import get_raw_queries
+from core.cache import get_cache_path, open_cache, save_cache
+from core.miscellaneous import print_log
+
+if __name__ == "__main__":
+    number_of_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    df_raw_queries = get_raw_queries(number_of_rows = number_of_rows, number_of_distinct_queries = number_of_rows // 10)
+    os.makedirs("cache", exist_ok = True)
+
+    for cache_format in ["json", "feather", "parquet"]:
+        cache_name = "benchmark_queries_raw"
+
+        start_time = time.perf_counter()
+        save_cache(df_raw_queries, cache_name, { "enabled": True, "format": cache_format })
+        save_time = time.perf_counter() - start_time
+        file_size = os.path.getsize(get_cache_path(cache_name, cache_format))
+
+        start_time = time.perf_counter()
+        df_loaded = open_cache(cache_name)
+        load_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        open_cache(cache_name, columns = ["date_key", "count"])
+        column_load_time = time.perf_counter() - start_time
+
+        identical = df_loaded.reset_index(drop = True).equals(df_raw_queries.reset_index(drop = True))
+        print_log("{cache_format}: save {save_time:.2f}s, load {load_time:.2f}s, load 2 columns {column_load_time:.2f}s, {size:.1f} MB, identical: {identical}".format(cache_format = cache_format, save_time = save_time, load_time = load_time, column_load_time = column_load_time, size = file_size / 1024 ** 2, identical = identical))
+
+        os.remove(get_cache_path(cache_name, cache_format))
@@ -0,0 +1,95 @@
+import re
+import sys
+import threading
+import time
+import pandas as pd
+
+sys.path.append(".")
+
+from benchmark.synthetic import get_model_rows
+from core.ingestion import execute_dmv_session, get_connection_string, get_model_objects, get_storage
+from core.miscellaneous import print_log
+
+DMV_KEYWORDS = [("DISCOVER_STORAGE_TABLE_COLUMN_SEGMENTS", "get_storage_table_segments")
+                , ("DISCOVER_STORAGE_TABLE_COLUMNS", "get_storage_dictionary")
+                , ("TMSCHEMA_TABLES", "get_tables")
+                , ("TMSCHEMA_COLUMNS", "get_columns")
+                , ("TMSCHEMA_MEASURES", "get_measures")]
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+
+    def execute(self, query):
+        time.sleep(self.connection.provider.query_latency)
+        workspace, dataset = re.findall("'([^']*)'", query)[:2]
+        self.rows = self.connection.provider.get_rows(query, workspace, dataset)
+        return self
+
+    def fetchone(self):
+        for row in self.rows:
+            yield row
+
+class FakeConnection:
+    def __init__(self, provider):
+        self.provider = provider
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        pass
+
+class FakeDmvProvider:
+    def __init__(self, handshake_latency = 0.2, query_latency = 0.02, failing_datasets = [], **scale):
+        self.handshake_latency = handshake_latency
+        self.query_latency = query_latency
+        self.failing_datasets = failing_datasets
+        self.scale = scale
+        self.lock = threading.Lock()
+        self.handshakes = 0
+
+    def __call__(self, connection_string):
+        with self.lock:
+            self.handshakes += 1
+        time.sleep(self.handshake_latency)
+        if re.search("catalog=([^;]*);", connection_string).group(1) in self.failing_datasets:
+            raise ConnectionError("Fake connection refused")
+        return FakeConnection(self)
+
+    def get_rows(self, query, workspace, dataset):
+        for keyword, query_name in DMV_KEYWORDS:
+            if keyword in query:
+                return get_model_rows(workspace, dataset, **self.scale)[query_name]
+        return []
+
+def get_per_query_connections(df_scope, configuration, queries, connection_factory):
+    for workspace, dataset in df_scope[["workspace_server", "dataset_database"]].itertuples(index = False, name = None):
+        connection_string = get_connection_string(configuration, workspace, dataset)
+        for query_name in queries["dmv"]:
+            execute_dmv_session(workspace, dataset, connection_string, queries, [query_name], connection_factory)
+
+if __name__ == "__main__":
+    import yaml
+
+    with open("queries.yml") as f:
+        queries = yaml.load(f, Loader = yaml.loader.SafeLoader)
+
+    number_of_datasets = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    df_scope = pd.DataFrame({ "workspace_server": ["Workspace {0}".format(index % 4) for index in range(number_of_datasets)], "dataset_database": ["Dataset {0}".format(index) for index in range(number_of_datasets)] })
+    configuration = { "mode": "power_bi", "azure": { "application_id": "app", "secret_key": "secret", "tenant_name": "tenant", "tenant_id": "tenant" } }
+
+    provider = FakeDmvProvider()
+    start_time = time.perf_counter()
+    get_per_query_connections(df_scope, configuration, queries, provider)
+    print_log("One connection per DMV query: {duration:.2f}s, {handshakes} handshakes".format(duration = time.perf_counter() - start_time, handshakes = provider.handshakes))
+
+    for parallelism in [1, 4, 8]:
+        provider = FakeDmvProvider(failing_datasets = ["Dataset 3"])
+        configuration["dmv"] = { "parallelism": parallelism }
+
+        start_time = time.perf_counter()
+        df_objects = get_model_objects(df_scope, configuration, queries, provider)
+        df_storage = get_storage(df_scope, df_objects, configuration, queries, provider)
+        print_log("One session per dataset and stage, parallelism {parallelism}: {duration:.2f}s, {handshakes} handshakes, {objects} objects".format(parallelism = parallelism, duration = time.perf_counter() - start_time, handshakes = provider.handshakes, objects = len(df_objects)))
@@ -0,0 +1,56 @@
+import sys
+import time
+import pandas as pd
+import yaml
+
+sys.path.append(".")
+
+from benchmark.dmv import FakeDmvProvider
+from benchmark.synthetic import get_raw_queries, get_scope
+from core.ingestion import get_model_objects
+from core.miscellaneous import print_log
+from core.processing import IDENTIFIER_COLUMNS, get_identifiers, get_parsed_queries, set_object_codes
+
+def get_memory(df):
+    return df.memory_usage(deep = True).sum() / 1024 ** 2
+
+def measure(function, **args):
+    start_time = time.perf_counter()
+    df_result = function(**args)
+    return df_result, time.perf_counter() - start_time
+
+# Reference: the grid repeats every name and is joined on the four name columns
+def get_string_usage_grid(df_dates, df_objects, df_parsed_queries):
+    df_grid = pd.merge(df_dates, df_objects, how = "cross")
+    return pd.merge(df_grid, df_parsed_queries[IDENTIFIER_COLUMNS + ["date_key", "count_query", "count_call"]], on = IDENTIFIER_COLUMNS + ["date_key"], how = "left")
+
+def get_coded_usage_grid(df_dates, df_objects, df_parsed_queries):
+    df_grid = pd.merge(df_dates, df_objects, how = "cross")
+    return pd.merge(df_grid, df_parsed_queries, on = ["object_code", "date_key"], how = "left")
+
+if __name__ == "__main__":
+    number_of_datasets = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    number_of_days = int(sys.argv[2]) if len(sys.argv) > 2 else 90
+
+    with open("queries.yml") as f:
+        queries = yaml.load(f, Loader = yaml.loader.SafeLoader)
+
+    configuration = { "mode": "power_bi", "azure": { "application_id": "app", "secret_key": "secret", "tenant_name": "tenant", "tenant_id": "tenant" } }
+    provider = FakeDmvProvider(handshake_latency = 0, query_latency = 0, number_of_measures = 200)
+    df_objects = get_model_objects(get_scope(number_of_datasets), configuration, queries, connection_factory = provider)
+    df_parsed_queries = get_parsed_queries(get_raw_queries(number_of_rows = 200000, number_of_datasets = number_of_datasets, number_of_days = number_of_days, number_of_measures = 200), df_objects)
+    df_dates = pd.DataFrame({ "date_key": sorted(df_parsed_queries["date_key"].unique()) })
+
+    df_string_objects = df_objects.drop(["query", "table_id", "object_id"], axis = 1)
+    df_string_grid, string_time = measure(get_string_usage_grid, df_dates = df_dates, df_objects = df_string_objects, df_parsed_queries = df_parsed_queries)
+
+    df_identifiers, identifiers_time = measure(get_identifiers, df_objects = df_objects)
+    df_coded_parsed_queries = set_object_codes(df_parsed_queries, df_identifiers)[["object_code", "date_key", "count_query", "count_call"]]
+    df_coded_grid, coded_time = measure(get_coded_usage_grid, df_dates = df_dates, df_objects = df_identifiers[["object_code"]], df_parsed_queries = df_coded_parsed_queries)
+
+    identical = df_string_grid["count_call"].fillna(0).sum() == df_coded_grid["count_call"].fillna(0).sum() and len(df_string_grid) == len(df_coded_grid)
+
+    print_log("{objects} objects, {days} days, {rows} grid rows".format(objects = len(df_objects), days = len(df_dates), rows = len(df_coded_grid)))
+    print_log("Names: {memory:.1f} MB grid, {time:.2f}s cross join and merge".format(memory = get_memory(df_string_grid), time = string_time))
+    print_log("Codes: {memory:.1f} MB grid, {time:.2f}s cross join and merge, {identifiers_time:.3f}s to build the identifiers".format(memory = get_memory(df_coded_grid), time = coded_time, identifiers_time = identifiers_time))
+    print_log("Memory: x{memory:.1f} smaller, merge: x{speedup:.1f} faster, same totals: {identical}".format(memory = get_memory(df_string_grid) / get_memory(df_coded_grid), speedup = string_time / coded_time, identical = identical))
@@ -0,0 +1,44 @@
+import argparse
+import statistics
+import subprocess
+import sys
+
+sys.path.append(".")
+
+from core.miscellaneous import print_log
+
+BACKEND_MODULES = ["azure.identity", "azure.monitor.query", "azure.core.exceptions", "pyadomd", "clr"]
+
+# Each measure runs in a fresh interpreter, nothing is already in sys.modules
+MEASURE_SCRIPT = """
+import importlib.util
+import sys
+import time
+
+sys.path.append("resources")
+start_time = time.perf_counter()
+import execute
+for name in {backends}:
+    if importlib.util.find_spec(name.split(".")[0]) is not None:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            pass
+elapsed = time.perf_counter() - start_time
+print(elapsed, ",".join(name for name in {modules} if name in sys.modules))
+"""
+
+def measure(backends):
+    output = subprocess.run([sys.executable, "-c", MEASURE_SCRIPT.format(backends = backends, modules = BACKEND_MODULES)], capture_output = True, text = True, check = True).stdout.split()
+    return float(output[0]), output[1].split(",") if len(output) > 1 else []
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Compare the start up of execute.py with lazy and eager backend imports")
+    parser.add_argument("--repeat", type = int, default = 5)
+    arguments = parser.parse_args()
+
+    # Eager loads the backends like the entry point did before they were imported by the stages
+    for label, backends in [("Lazy", []), ("Eager", BACKEND_MODULES)]:
+        results = [measure(backends) for _ in range(arguments.repeat)]
+        loaded_modules = results[-1][1]
+        print_log("{label}: {median:.3f}s median start up over {repeat} runs, backends loaded: {modules}".format(label = label, median = statistics.median([result[0] for result in results]), repeat = arguments.repeat, modules = ", ".join(loaded_modules) if len(loaded_modules) > 0 else "none"))
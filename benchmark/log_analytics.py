@@ -0,0 +1,118 @@
+import random
+import re
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from azure.core.exceptions import HttpResponseError
+from azure.monitor.query import LogsQueryStatus
+
+sys.path.append(".")
+
+from core.ingestion import get_log_analytics_raw_queries
+from core.miscellaneous import print_log
+
+class FakeLogsQueryClient:
+    def __init__(self, partitions, rows_per_partition = 100, latency = 0.2, throttling_rate = 0.1, max_concurrency = 4, seed = 0, query_texts = None, row_cap = None, busy_partitions = (), busy_factor = 10):
+        self.partitions = partitions
+        self.row_cap = row_cap
+        self.busy_partitions = set(busy_partitions)
+        self.busy_factor = busy_factor
+        self.query_texts = query_texts
+        self.rows_per_partition = rows_per_partition
+        self.latency = latency
+        self.throttling_rate = throttling_rate
+        self.max_concurrency = max_concurrency
+        self.random_generator = random.Random(seed)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.calls = 0
+        self.throttled = 0
+
+    def get_response(self, columns, rows):
+        # Like the service, a result over the row cap is cut and flagged as partial
+        if self.row_cap is not None and len(rows) > self.row_cap:
+            table = SimpleNamespace(columns = columns, rows = rows[:self.row_cap])
+            return SimpleNamespace(status = LogsQueryStatus.PARTIAL, partial_data = [table], partial_error = "Query result exceeded {row_cap} rows".format(row_cap = self.row_cap))
+
+        table = SimpleNamespace(columns = columns, rows = rows)
+        return SimpleNamespace(status = LogsQueryStatus.SUCCESS, tables = [table])
+
+    def get_partition_rows(self, partition, window = None):
+        number_of_rows = self.rows_per_partition * (self.busy_factor if partition in self.busy_partitions else 1)
+
+        # Rows are spread evenly over the hour so that a time window returns a slice of them
+        partition_start = datetime.strptime(partition, "%Y-%m-%d-%H")
+        indexes = range(number_of_rows)
+        if window is not None:
+            indexes = [index for index in indexes if window[0] <= partition_start + timedelta(seconds = 3600 * index / number_of_rows) < window[1]]
+
+        if self.query_texts is None:
+            return [["Workspace", "Dataset", "EVALUATE 'Table'[Column {0}]".format(index), partition[:10], 1] for index in indexes]
+
+        # A new string per row, as the service returns one copy of the text per row
+        return [["Workspace", "Dataset", "{0} -- {1}".format(self.query_texts[index % len(self.query_texts)], partition), partition[:10], 1] for index in indexes]
+
+    def query_workspace(self, workspace_id, query, timespan):
+        with self.lock:
+            self.calls += 1
+            throttle = self.running >= self.max_concurrency or self.random_generator.random() < self.throttling_rate
+            if throttle:
+                self.throttled += 1
+            else:
+                self.running += 1
+
+        if throttle:
+            error = HttpResponseError(message = "Too many requests")
+            error.status_code = 429
+            raise error
+
+        try:
+            time.sleep(self.latency)
+            if "distinct partition" in query:
+                return self.get_response(["partition"], [[partition] for partition in self.partitions])
+
+            partition = re.search(r'== "([0-9]{4}-[0-9]{2}-[0-9]{2}-[0-9]{2})"', query).group(1)
+            window = [datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ") for value in re.findall(r"datetime\(([^)]*)\)", query)] or None
+            return self.get_response(["workspace_server", "dataset_database", "query", "date_key", "count"], self.get_partition_rows(partition, window))
+        finally:
+            with self.lock:
+                self.running -= 1
+
+def get_partitions(number_of_days):
+    current_time = datetime.today().replace(minute = 0, second = 0, microsecond = 0)
+    return [(current_time - timedelta(hours = hour)).strftime("%Y-%m-%d-%H") for hour in range(number_of_days * 24)]
+
+if __name__ == "__main__":
+    import yaml
+
+    with open("queries.yml") as f:
+        queries = yaml.load(f, Loader = yaml.loader.SafeLoader)
+
+    number_of_days = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    partitions = get_partitions(number_of_days)
+
+    for parallelism in [1, 4, 8]:
+        configuration = { "mode": "power_bi", "cache": { "enabled": False }, "log_analytics": { "workspace_id": "fake", "search_dept": number_of_days, "parallelism": parallelism, "retry_delay": 0.05 } }
+        client = FakeLogsQueryClient(partitions, latency = 0.05)
+
+        start_time = time.perf_counter()
+        df_raw_queries = get_log_analytics_raw_queries(queries, configuration, client)
+        duration = time.perf_counter() - start_time
+
+        print_log("Parallelism {parallelism}: {rows} rows in {duration:.2f}s, {calls} calls, {throttled} throttled".format(parallelism = parallelism, rows = len(df_raw_queries), duration = duration, calls = client.calls, throttled = client.throttled))
+
+    # Busy hours go over the row cap and are split until every window fits
+    configuration = { "mode": "power_bi", "cache": { "enabled": False }, "log_analytics": { "workspace_id": "fake", "search_dept": number_of_days, "parallelism": 4, "retry_delay": 0.05 } }
+    busy_partitions = partitions[::6]
+    df_expected = get_log_analytics_raw_queries(queries, configuration, FakeLogsQueryClient(partitions, latency = 0, throttling_rate = 0, busy_partitions = busy_partitions))
+
+    client = FakeLogsQueryClient(partitions, latency = 0.05, throttling_rate = 0, row_cap = 300, busy_partitions = busy_partitions)
+    start_time = time.perf_counter()
+    df_raw_queries = get_log_analytics_raw_queries(queries, configuration, client)
+    duration = time.perf_counter() - start_time
+
+    keys = ["partition", "query"]
+    identical = df_raw_queries.sort_values(keys).reset_index(drop = True).equals(df_expected.sort_values(keys).reset_index(drop = True))
+    print_log("Row cap 300 with {busy} busy partitions: {rows} rows in {duration:.2f}s, {calls} calls, same rows as without cap: {identical}".format(busy = len(busy_partitions), rows = len(df_raw_queries), duration = duration, calls = client.calls, identical = identical))
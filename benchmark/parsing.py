@@ -0,0 +1,85 @@
+import os
+import re
+import sys
+import tempfile
+import time
+import pandas as pd
+
+sys.path.append(".")
+
+from benchmark.synthetic import get_raw_queries
+from core.miscellaneous import print_log
+from core.processing import USED_COLUMNS_REGEX, get_query_usage
+
+# Reference implementation: one regex pass per row, then explode
+def get_row_wise_used_columns(df_raw_queries):
+    def get_matches(query):
+        result = []
+        for match in re.findall(USED_COLUMNS_REGEX, query):
+            if match[0] != "":
+                result.append((match[0].upper(), match[1].upper()))
+            elif match[2] != "":
+                result.append((match[2].upper(), match[3].upper()))
+            elif match[4] != "":
+                result.append((match[4].upper(), match[5].upper()))
+            else:
+                result.append((None, match[6].upper()))
+        return result
+
+    df_working = df_raw_queries.copy()
+    df_working["query_id"] = pd.RangeIndex(stop = df_working.shape[0])
+    df_working["data"] = df_working["query"].apply(get_matches)
+    df_working = df_working.explode("data").dropna(subset = ["data"])
+    df_working["table_name"] = df_working["data"].str[0]
+    df_working["object_name"] = df_working["data"].str[1]
+
+    keys = ["workspace_server", "dataset_database", "date_key", "table_name", "object_name"]
+    df_query_level = df_working.drop_duplicates(keys + ["query_id"]).groupby(keys, as_index = False)["count"].sum().rename(columns = { "count" : "count_query" })
+    df_column_level = df_working.groupby(keys, as_index = False)["count"].sum().rename(columns = { "count" : "count_call" })
+
+    return pd.merge(df_query_level, df_column_level, on = keys, how = "inner")
+
+def measure(function, df_raw_queries, **args):
+    start_time = time.perf_counter()
+    df_result = function(df_raw_queries, **args)
+    return df_result, time.perf_counter() - start_time
+
+if __name__ == "__main__":
+    number_of_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    number_of_distinct_queries = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count() or 1
+
+    df_raw_queries = get_raw_queries(number_of_rows = number_of_rows, number_of_distinct_queries = number_of_distinct_queries)
+    print_log("Synthetic corpus: {rows} rows, {distinct} distinct queries".format(rows = len(df_raw_queries), distinct = df_raw_queries["query"].nunique()))
+
+    df_row_wise, row_wise_time = measure(get_row_wise_used_columns, df_raw_queries)
+    df_deduplicated, deduplicated_time = measure(get_query_usage, df_raw_queries)
+
+    keys = ["workspace_server", "dataset_database", "date_key", "table_name", "object_name"]
+    df_row_wise = df_row_wise.sort_values(keys).reset_index(drop = True)
+    df_deduplicated = df_deduplicated.sort_values(keys).reset_index(drop = True)[df_row_wise.columns]
+    identical = df_row_wise.astype(str).equals(df_deduplicated.astype(str))
+
+    print_log("Row wise: {time:.2f}s".format(time = row_wise_time))
+    print_log("Deduplicated: {time:.2f}s".format(time = deduplicated_time))
+    print_log("Speedup: x{speedup:.1f}, identical aggregates: {identical}".format(speedup = row_wise_time / deduplicated_time, identical = identical))
+
+    # The pool is forced even on small corpora to show its startup cost
+    df_parallel, parallel_time = measure(get_query_usage, df_raw_queries, parsing_configuration = { "workers": workers, "min_queries_per_shard": 1 })
+    df_parallel = df_parallel.sort_values(keys).reset_index(drop = True)[df_row_wise.columns]
+    print_log("Parallel with {workers} workers: {time:.2f}s, speedup over deduplicated: x{speedup:.1f}, identical aggregates: {identical}".format(workers = workers, time = parallel_time, speedup = deduplicated_time / parallel_time, identical = df_parallel.equals(df_deduplicated)))
+
+    # A second audit over the same texts reads every reference back from the parse store
+    working_directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        os.makedirs("cache")
+        try:
+            cache_configuration = { "enabled": True, "format": "parquet" }
+            _, cold_time = measure(get_query_usage, df_raw_queries, parsing_configuration = {}, cache_configuration = cache_configuration)
+            df_stored, warm_time = measure(get_query_usage, df_raw_queries, parsing_configuration = {}, cache_configuration = cache_configuration)
+        finally:
+            os.chdir(working_directory)
+
+    df_stored = df_stored.sort_values(keys).reset_index(drop = True)[df_row_wise.columns]
+    print_log("Parse store: {cold_time:.2f}s cold, {warm_time:.2f}s warm, identical aggregates: {identical}".format(cold_time = cold_time, warm_time = warm_time, identical = df_stored.equals(df_deduplicated)))
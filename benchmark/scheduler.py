@@ -0,0 +1,90 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+import yaml
+
+# Absolute, as the runs happen in a temporary directory and the spawned workers import this script again
+sys.path.append(os.path.abspath("."))
+
+from benchmark.dmv import FakeDmvProvider
+from benchmark.synthetic import get_raw_queries, get_scope
+from core import ingestion, metrics
+from core.miscellaneous import print_log
+from core.scheduler import run_stages
+from execute import get_stages
+
+def get_fake_stages(scale, latency):
+    model_scale = dict(number_of_tables = scale["tables"], number_of_columns = scale["columns"], number_of_measures = scale["measures"], depth = 4)
+    provider = FakeDmvProvider(handshake_latency = latency, query_latency = latency / 10, **model_scale)
+    df_raw_queries = get_raw_queries(number_of_rows = scale["rows"], number_of_distinct_queries = scale["distinct_queries"], number_of_datasets = scale["datasets"], number_of_days = scale["days"], number_of_tables = scale["tables"], number_of_columns = scale["columns"], number_of_measures = scale["measures"])
+
+    # Only the data sources are faked: one Log Analytics round trip per day and the DMV provider latencies
+    def get_log_analytics_raw_queries(configuration, queries):
+        time.sleep(latency * scale["days"])
+        return df_raw_queries.copy()
+
+    def get_available_scope(configuration, queries):
+        time.sleep(latency)
+        return get_scope(scale["datasets"])
+
+    def get_model_objects(configuration, queries, df_scope):
+        return ingestion.get_model_objects(df_scope, configuration, queries, connection_factory = provider)
+
+    def get_storage(configuration, queries, df_scope, df_objects):
+        return ingestion.get_storage(df_scope, df_objects, configuration, queries, connection_factory = provider)
+
+    fake_functions = { "queries_raw": get_log_analytics_raw_queries, "available_scope": get_available_scope, "model_objects": get_model_objects, "storage": get_storage }
+
+    return [dict(stage, function = fake_functions.get(stage["name"], stage["function"])) for stage in get_stages(False)]
+
+def get_longest_path(stages, durations):
+    outputs = { stage["output"]: stage["name"] for stage in stages }
+    finish_times = {}
+    for stage in stages:
+        upstreams = [outputs[input_name] for input_name in stage["inputs"] if input_name in outputs]
+        finish_times[stage["name"]] = max([finish_times[upstream] for upstream in upstreams], default = 0) + durations[stage["name"]]
+
+    return max(finish_times.values())
+
+def run(scale, latency, queries, scheduler_configuration):
+    configuration = { "mode": "power_bi", "log_analytics": {}, "azure": { "application_id": "app", "secret_key": "secret", "tenant_name": "tenant", "tenant_id": "tenant" } }
+    cache_configuration = { "enabled": False, "use_raw_queries_cache": False, "use_scope_cache": False, "use_model_cache": False, "use_storage_cache": False, "use_parsed_queries_cache": False }
+    stages = get_fake_stages(scale, latency)
+    metrics.run_metrics.clear()
+
+    start_time = time.perf_counter()
+    run_stages(stages, { "configuration": configuration, "queries": queries, "output_configuration": {}, "cache_configuration": cache_configuration }, cache_configuration, scheduler_configuration)
+    wall_time = time.perf_counter() - start_time
+
+    return wall_time, { record["stage"]: record["wall_time"] for record in metrics.run_metrics }, stages
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Compare the sequential and the concurrent stage scheduling on fake data sources")
+    parser.add_argument("--datasets", type = int, default = 5)
+    parser.add_argument("--tables", type = int, default = 10)
+    parser.add_argument("--columns", type = int, default = 20, help = "columns per table")
+    parser.add_argument("--measures", type = int, default = 200, help = "measures per dataset")
+    parser.add_argument("--days", type = int, default = 30)
+    parser.add_argument("--rows", type = int, default = 200000, help = "raw query rows")
+    parser.add_argument("--distinct-queries", type = int, default = 5000)
+    parser.add_argument("--latency", type = float, default = 0.1, help = "seconds per fake round trip")
+    arguments = parser.parse_args()
+
+    with open("queries.yml") as f:
+        queries = yaml.load(f, Loader = yaml.loader.SafeLoader)
+
+    scale = dict(datasets = arguments.datasets, tables = arguments.tables, columns = arguments.columns, measures = arguments.measures, days = arguments.days, rows = arguments.rows, distinct_queries = arguments.distinct_queries)
+    working_directory = os.getcwd()
+
+    for scheduler_configuration in [{ "parallelism": 1 }, { "parallelism": 4 }, { "parallelism": 4, "use_processes": True }]:
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            os.makedirs("output")
+            try:
+                wall_time, durations, stages = run(scale, arguments.latency, queries, scheduler_configuration)
+            finally:
+                os.chdir(working_directory)
+
+        print_log("Parallelism {parallelism}{processes}: {wall_time:.2f}s wall, {total:.2f}s sum of stages, {longest_path:.2f}s longest path".format(parallelism = scheduler_configuration["parallelism"], processes = " with processes" if scheduler_configuration.get("use_processes", False) else "", wall_time = wall_time, total = sum(durations.values()), longest_path = get_longest_path(stages, durations)))
@@ -0,0 +1,103 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import pandas as pd
+import yaml
+
+sys.path.append(".")
+
+from benchmark.dmv import FakeDmvProvider
+from benchmark.synthetic import get_raw_queries, get_scope
+from core.export import export_output, get_output_storage, get_output_usage_by_object
+from core.ingestion import get_model_objects, get_storage
+from core.miscellaneous import print_log
+from core.processing import get_model_dependencies, get_parsed_queries
+
+def get_rows(value):
+    return len(value) if isinstance(value, pd.DataFrame) else None
+
+def measure(function, trace_memory, **args):
+    gc.collect()
+    if trace_memory:
+        tracemalloc.start()
+
+    start_time = time.perf_counter()
+    start_cpu_time = time.process_time()
+    result = function(**args)
+    metrics = { "wall_time": time.perf_counter() - start_time, "cpu_time": time.process_time() - start_cpu_time }
+
+    if trace_memory:
+        metrics["peak_memory_mb"] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+        tracemalloc.stop()
+
+    metrics["input_rows"] = sum(get_rows(value) or 0 for value in args.values())
+    metrics["output_rows"] = get_rows(result)
+
+    return result, metrics
+
+def run_stages(scale, queries, trace_memory):
+    configuration = { "mode": "power_bi", "azure": { "application_id": "app", "secret_key": "secret", "tenant_name": "tenant", "tenant_id": "tenant" } }
+    model_scale = dict(number_of_tables = scale["tables"], number_of_columns = scale["columns"], number_of_measures = scale["measures"], depth = scale["depth"])
+    provider = FakeDmvProvider(handshake_latency = 0, query_latency = 0, **model_scale)
+    df_scope = get_scope(scale["datasets"])
+    df_raw_queries = get_raw_queries(number_of_rows = scale["rows"], number_of_distinct_queries = scale["distinct_queries"], number_of_datasets = scale["datasets"], number_of_days = scale["days"], number_of_tables = scale["tables"], number_of_columns = scale["columns"], number_of_measures = scale["measures"])
+
+    metrics = {}
+    df_objects, metrics["get_model_objects"] = measure(get_model_objects, trace_memory, df_scope = df_scope, configuration = configuration, queries = queries, connection_factory = provider)
+    df_storage, metrics["get_storage"] = measure(get_storage, trace_memory, df_scope = df_scope, df_objects = df_objects, configuration = configuration, queries = queries, connection_factory = provider)
+    df_dependencies, metrics["get_model_dependencies"] = measure(get_model_dependencies, trace_memory, df_objects = df_objects)
+    df_parsed_queries, metrics["get_parsed_queries"] = measure(get_parsed_queries, trace_memory, df_raw_queries = df_raw_queries, df_objects = df_objects)
+    df_usage, metrics["get_output_usage_by_object"] = measure(get_output_usage_by_object, trace_memory, df_parsed_queries = df_parsed_queries, df_objects = df_objects, df_dependencies = df_dependencies)
+    df_output_storage, metrics["get_output_storage"] = measure(get_output_storage, trace_memory, df_storage = df_storage, df_parsed_queries = df_parsed_queries)
+    _, metrics["export_output"] = measure(export_output, trace_memory, df_export = df_usage, export_name = "usage_by_objects", partionned = True)
+
+    return metrics
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Time and measure the peak memory of each TUS stage on a synthetic workload")
+    parser.add_argument("--datasets", type = int, default = 5)
+    parser.add_argument("--tables", type = int, default = 10)
+    parser.add_argument("--columns", type = int, default = 20, help = "columns per table")
+    parser.add_argument("--measures", type = int, default = 200, help = "measures per dataset")
+    parser.add_argument("--depth", type = int, default = 4, help = "levels of measures referencing measures")
+    parser.add_argument("--days", type = int, default = 30)
+    parser.add_argument("--rows", type = int, default = 100000, help = "raw query rows")
+    parser.add_argument("--distinct-queries", type = int, default = 5000)
+    parser.add_argument("--no-memory", action = "store_true", help = "skip the traced run measuring peak memory")
+    parser.add_argument("--output", help = "JSON file receiving the results")
+    arguments = parser.parse_args()
+
+    with open("queries.yml") as f:
+        queries = yaml.load(f, Loader = yaml.loader.SafeLoader)
+
+    scale = dict(datasets = arguments.datasets, tables = arguments.tables, columns = arguments.columns, measures = arguments.measures, depth = arguments.depth, days = arguments.days, rows = arguments.rows, distinct_queries = arguments.distinct_queries)
+    working_directory = os.getcwd()
+
+    # Timings and peak memory come from separate runs as tracing slows the stages down
+    passes = [False] if arguments.no_memory else [False, True]
+    stages = {}
+    for trace_memory in passes:
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            os.makedirs("output")
+            try:
+                for stage, metrics in run_stages(scale, queries, trace_memory).items():
+                    stages.setdefault(stage, {}).update(metrics if not trace_memory else { "peak_memory_mb": metrics["peak_memory_mb"] })
+            finally:
+                os.chdir(working_directory)
+
+    for stage, metrics in stages.items():
+        print_log("{stage}: {wall_time:.2f}s wall, {cpu_time:.2f}s cpu, {peak_memory} MB peak, {input_rows} rows in, {output_rows} rows out".format(stage = stage, peak_memory = "{0:.1f}".format(metrics["peak_memory_mb"]) if "peak_memory_mb" in metrics else "-", **{ key: value for key, value in metrics.items() if key != "peak_memory_mb" }))
+
+    results = { "scale": scale, "environment": { "python": platform.python_version(), "pandas": pd.__version__, "platform": platform.platform() }, "stages": stages }
+    if arguments.output is not None:
+        with open(arguments.output, "w") as f:
+            json.dump(results, f, indent = 2)
+    else:
+        print(json.dumps(results, indent = 2))
@@ -0,0 +1,41 @@
+import multiprocessing
+import resource
+import sys
+import time
+
+sys.path.append(".")
+
+from core.miscellaneous import print_log
+
+def run(streaming, number_of_days, rows_per_partition):
+    import yaml
+    from benchmark.log_analytics import FakeLogsQueryClient, get_partitions
+    from benchmark.synthetic import get_raw_queries
+    from core.ingestion import get_log_analytics_query_usage, get_log_analytics_raw_queries
+    from core.processing import get_query_usage
+
+    with open("queries.yml") as f:
+        queries = yaml.load(f, Loader = yaml.loader.SafeLoader)
+
+    query_texts = get_raw_queries(number_of_rows = 2000, number_of_distinct_queries = 2000)["query"].drop_duplicates().tolist()
+    client = FakeLogsQueryClient(get_partitions(number_of_days), rows_per_partition = rows_per_partition, latency = 0, throttling_rate = 0, query_texts = query_texts)
+    configuration = { "mode": "power_bi", "cache": { "enabled": False }, "log_analytics": { "workspace_id": "fake", "search_dept": number_of_days } }
+
+    start_time = time.perf_counter()
+    if streaming:
+        df_query_usage = get_log_analytics_query_usage(queries, configuration, client)
+    else:
+        df_query_usage = get_query_usage(get_log_analytics_raw_queries(queries, configuration, client))
+
+    return time.perf_counter() - start_time, len(df_query_usage), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+if __name__ == "__main__":
+    rows_per_partition = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    context = multiprocessing.get_context("spawn")
+
+    for number_of_days in [2, 4, 8]:
+        for streaming in [False, True]:
+            # A fresh process per run so that the peak RSS of one run does not hide the next
+            with context.Pool(1) as pool:
+                duration, rows, peak_rss = pool.apply(run, (streaming, number_of_days, rows_per_partition))
+            print_log("{mode}, {days} days: {duration:.1f}s, {rows} usage rows, peak RSS {peak_rss:.0f} MB".format(mode = "Streaming" if streaming else "Full raw", days = number_of_days, duration = duration, rows = rows, peak_rss = peak_rss))
@@ -0,0 +1,77 @@
+import random
+import pandas as pd
+from datetime import date, timedelta
+
+def get_scope(number_of_datasets = 5):
+    return pd.DataFrame({
+        "workspace_server": ["Workspace {0}".format(index % 3) for index in range(number_of_datasets)],
+        "dataset_database": ["Dataset {0}".format(index) for index in range(number_of_datasets)]
+    })
+
+def get_measure_table(measure, number_of_tables):
+    return measure % number_of_tables
+
+def get_column_reference(random_generator, number_of_tables, number_of_columns):
+    table = random_generator.randrange(number_of_tables)
+    column = random_generator.randrange(number_of_columns)
+    if random_generator.random() < 0.5:
+        return "'Table{table}'[Column {column}]".format(table = table, column = column)
+    return "Table{table}[Column {column}]".format(table = table, column = column)
+
+def get_measure_reference(measure, number_of_tables, random_generator):
+    if random_generator.random() < 0.5:
+        return " [Measure {measure}]".format(measure = measure)
+    return "'Table{table}'[Measure {measure}]".format(table = get_measure_table(measure, number_of_tables), measure = measure)
+
+def get_model_rows(workspace, dataset, number_of_tables = 10, number_of_columns = 20, number_of_measures = 50, depth = 4, seed = 0):
+    random_generator = random.Random("{seed}-{workspace}-{dataset}".format(seed = seed, workspace = workspace, dataset = dataset))
+    rows = { "get_tables": [], "get_columns": [], "get_measures": [], "get_storage_dictionary": [], "get_storage_table_segments": [] }
+
+    for table in range(number_of_tables):
+        table_id = 1000 + table
+        rows["get_tables"].append([workspace, dataset, table_id, "Table{0}".format(table)])
+
+        for column in range(number_of_columns):
+            column_id = table_id * 1000 + column
+            storage_id = "Column {column} ({column_id})".format(column = column, column_id = column_id)
+            rows["get_columns"].append([workspace, dataset, "COLUMN", column_id, table_id, "Column {0}".format(column), None, None])
+            rows["get_storage_dictionary"].append([workspace, dataset, storage_id, random_generator.randint(1, 10 ** 6)])
+            rows["get_storage_table_segments"].append([workspace, dataset, storage_id, "Table{table} ({table_id})".format(table = table, table_id = table_id), random_generator.randint(1, 10 ** 7)])
+
+    # Measures of level n only reference measures of level n - 1, level 0 measures reference columns
+    levels = [measure * depth // max(1, number_of_measures) for measure in range(number_of_measures)]
+    for measure in range(number_of_measures):
+        previous_level = [candidate for candidate in range(measure) if levels[candidate] == levels[measure] - 1]
+        references = []
+        for _ in range(random_generator.randint(1, 3)):
+            if len(previous_level) > 0:
+                references.append(get_measure_reference(random_generator.choice(previous_level), number_of_tables, random_generator))
+            else:
+                references.append("SUM({0})".format(get_column_reference(random_generator, number_of_tables, number_of_columns)))
+
+        table_id = 1000 + get_measure_table(measure, number_of_tables)
+        rows["get_measures"].append([workspace, dataset, "MEASURE", 500000 + measure, table_id, "Measure {0}".format(measure), " + ".join(references)])
+
+    return rows
+
+def get_raw_queries(number_of_rows = 100000, number_of_distinct_queries = 2000, number_of_datasets = 5, number_of_days = 30, number_of_tables = 10, number_of_columns = 20, number_of_measures = 50, seed = 0):
+    random_generator = random.Random(seed)
+    scope = list(get_scope(number_of_datasets).itertuples(index = False, name = None))
+
+    queries = []
+    for _ in range(number_of_distinct_queries):
+        references = []
+        for _ in range(random_generator.randint(1, 12)):
+            if random_generator.random() < 0.5:
+                references.append(get_column_reference(random_generator, number_of_tables, number_of_columns))
+            else:
+                references.append(get_measure_reference(random_generator.randrange(number_of_measures), number_of_tables, random_generator))
+        queries.append((random_generator.choice(scope), "EVALUATE SUMMARIZECOLUMNS(" + ", ".join(references) + ")"))
+
+    first_date = date.today() - timedelta(days = number_of_days)
+    rows = []
+    for _ in range(number_of_rows):
+        (workspace, dataset), query = queries[int(random_generator.paretovariate(1.2)) % number_of_distinct_queries]
+        rows.append([workspace, dataset, query, str(first_date + timedelta(days = random_generator.randrange(number_of_days))), random_generator.randint(1, 20)])
+
+    return pd.DataFrame(rows, columns = ["workspace_server", "dataset_database", "query", "date_key", "count"])
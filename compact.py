@@ -0,0 +1,12 @@
+from sys import argv
+
+from core.miscellaneous import print_log
+from core.export import compact_output
+
+export_names = argv[1:] if len(argv) > 1 else ["storage", "usage_by_objects"]
+
+for export_name in export_names:
+    print_log("Compact partitions of '{name}'".format(name = export_name))
+    compact_output(export_name)
+
+exit(0)
@@ -1,23 +1,215 @@
+import hashlib
+import json
 import os
+import threading
+import time
 import pandas as pd
 
+CACHE_EXTENSIONS = { "json": "zip", "feather": "feather", "parquet": "parquet" }
+
+# Stages may run concurrently: reads and writes of the index are serialized
+cache_index_lock = threading.RLock()
+
 def get_compression_options(name):
     return dict(method = "zip", archive_name = "{name}.json".format(name = name))  
 
-def get_cache_path(name):
-    return "cache/{name}.zip".format(name = name)
+def get_cache_path(name, cache_format = "json"):
+    return "cache/{name}.{extension}".format(name = name, extension = CACHE_EXTENSIONS[cache_format])
+
+def get_manifest_path(name):
+    return "cache/{name}.manifest.json".format(name = name)
+
+def get_index_path():
+    return "cache/index.json"
+
+def get_available_cache_format(name):
+    available_formats = [cache_format for cache_format in CACHE_EXTENSIONS if os.path.isfile(get_cache_path(name, cache_format))]
+    if len(available_formats) == 0:
+        return None
+
+    return max(available_formats, key = lambda cache_format: os.path.getmtime(get_cache_path(name, cache_format)))
 
 def cache_is_available(name):
-    file_path = get_cache_path(name)
-    return os.path.isfile(file_path)
+    return get_available_cache_format(name) is not None
+
+def get_temporary_path(file_path):
+    # Caches are also written by the worker processes, each writer gets its own file
+    return "{path}.{pid}.{thread}.tmp".format(path = file_path, pid = os.getpid(), thread = threading.get_ident())
 
 def save_cache(df, name, cache_configuration):
     if(cache_configuration["enabled"]):
-        file_path = get_cache_path(name)
+        cache_format = cache_configuration.get("format", "json")
+        file_path = get_cache_path(name, cache_format)
+        temporary_path = get_temporary_path(file_path)
+
+        if cache_format == "feather":
+            # Uncompressed Arrow IPC so the file can be memory-mapped when read back
+            df.reset_index(drop = True).to_feather(temporary_path, compression = "uncompressed")
+        elif cache_format == "parquet":
+            df.reset_index(drop = True).to_parquet(temporary_path, compression = "zstd", index = False)
+        else:
+            compression_options = get_compression_options(name)
+            df.to_json(temporary_path, orient = "table", compression = compression_options)
+        os.replace(temporary_path, file_path)
+
+        for other_format in CACHE_EXTENSIONS:
+            other_path = get_cache_path(name, other_format)
+            if other_format != cache_format and os.path.isfile(other_path):
+                os.remove(other_path)
+
+def open_cache(name, columns = None): 
+    cache_format = get_available_cache_format(name)
+    # The cache can be evicted by a concurrent stage between the check of the caller and the read
+    if cache_format is None:
+        return None
+    file_path = get_cache_path(name, cache_format)
+
+    try:
+        if cache_format == "feather":
+            from pyarrow import feather
+            return feather.read_table(file_path, columns = columns, memory_map = True).to_pandas()
+        elif cache_format == "parquet":
+            return pd.read_parquet(file_path, columns = columns)
+
         compression_options = get_compression_options(name)
-        df.to_json(file_path, orient = "table", compression = compression_options)
+        df = pd.read_json(file_path, orient = "table", compression = compression_options)
+    except FileNotFoundError:
+        return None
+    if columns is not None:
+        df = df[columns]
+
+    return df
+
+def save_manifest(manifest, name, cache_configuration):
+    if(cache_configuration["enabled"]):
+        temporary_path = get_temporary_path(get_manifest_path(name))
+        with open(temporary_path, "w") as f:
+            json.dump(manifest, f, indent = 2, sort_keys = True)
+        os.replace(temporary_path, get_manifest_path(name))
+
+def open_manifest(name):
+    file_path = get_manifest_path(name)
+    if not os.path.isfile(file_path):
+        return {}
+
+    with open(file_path) as f:
+        return json.load(f)
+
+# Fingerprints and eviction
+def get_frame_fingerprint(df):
+    fingerprint = hashlib.md5(",".join(map(str, df.columns)).encode())
+    fingerprint.update(pd.util.hash_pandas_object(df, index = False).to_numpy().tobytes())
+    return fingerprint.hexdigest()
+
+def get_fingerprint(value):
+    if isinstance(value, pd.DataFrame):
+        return value.attrs.get("fingerprint") or get_frame_fingerprint(value)
+
+    if isinstance(value, dict):
+        value = { str(key): get_fingerprint(item) for key, item in value.items() }
+    elif isinstance(value, (list, tuple)):
+        value = [get_fingerprint(item) for item in value]
+    elif value is not None and not isinstance(value, (str, int, float, bool)):
+        value = getattr(value, "__qualname__", type(value).__qualname__)
+
+    return hashlib.md5(json.dumps(value, sort_keys = True).encode()).hexdigest()
+
+def get_stage_settings(args, settings):
+    # Settings are paths in the inputs of the stage, like "configuration.log_analytics.search_dept"
+    stage_settings = {}
+    for setting in settings:
+        value = args
+        for key in setting.split("."):
+            value = value.get(key) if isinstance(value, dict) else None
+        stage_settings[setting] = value
+
+    return stage_settings
+
+def get_stage_key(function, args, settings = None, period = None):
+    # Only the settings declared by the stage are part of its key, the other settings tune the run and keep the cache
+    if settings is not None:
+        settings_inputs = set(setting.split(".")[0] for setting in settings)
+        args = dict({ name: value for name, value in args.items() if name not in settings_inputs }, settings = get_stage_settings(args, settings))
+    # A stage refreshed over time, like the incremental raw queries, gets a new key each period
+    if period is not None:
+        args = dict(args, period = period)
+
+    return get_fingerprint(dict(args, function = function.__name__))
+
+def open_cache_index():
+    file_path = get_index_path()
+    if not os.path.isfile(file_path):
+        return {}
+
+    with open(file_path) as f:
+        return json.load(f)
+
+def save_cache_index(index):
+    with open(get_index_path(), "w") as f:
+        json.dump(index, f, indent = 2, sort_keys = True)
+
+def get_cache_entry(name):
+    with cache_index_lock:
+        return open_cache_index().get(name)
+
+def cache_entry_is_valid(entry, key, cache_configuration):
+    if entry is None or entry["key"] != key:
+        return False
+
+    ttl_hours = cache_configuration.get("ttl_hours")
+    return ttl_hours is None or time.time() - entry["created_at"] <= ttl_hours * 3600
+
+def save_cache_entry(name, key, fingerprint, cache_configuration):
+    if(cache_configuration["enabled"]):
+        with cache_index_lock:
+            index = open_cache_index()
+            index[name] = { "key": key, "fingerprint": fingerprint, "created_at": time.time(), "last_used": time.time() }
+            save_cache_index(index)
+
+def touch_cache_entry(name, cache_configuration):
+    if(cache_configuration["enabled"]):
+        with cache_index_lock:
+            index = open_cache_index()
+            if name in index:
+                index[name]["last_used"] = time.time()
+                save_cache_index(index)
+
+def evict_cache(cache_configuration, keep = None):
+    ttl_hours = cache_configuration.get("ttl_hours")
+    max_size_mb = cache_configuration.get("max_size_mb")
+    if not cache_configuration["enabled"] or not os.path.isdir("cache") or (ttl_hours is None and max_size_mb is None):
+        return []
+
+    with cache_index_lock:
+        index = open_cache_index()
+        files = {}
+        for file_name in os.listdir("cache"):
+            file_path = os.path.join("cache", file_name)
+            if file_path != get_index_path() and not file_name.endswith(".tmp") and os.path.isfile(file_path):
+                files.setdefault(file_name.split(".")[0], []).append(file_path)
+
+        entries = []
+        for name, file_paths in files.items():
+            modified_at = max(os.path.getmtime(file_path) for file_path in file_paths)
+            entry = index.get(name, {})
+            entries.append((entry.get("last_used", modified_at), entry.get("created_at", modified_at), name, file_paths))
+
+        evicted = []
+        total_size = sum(os.path.getsize(file_path) for _, _, _, file_paths in entries for file_path in file_paths)
+        for last_used, created_at, name, file_paths in sorted(entries):
+            if name == keep:
+                continue
+
+            expired = ttl_hours is not None and time.time() - created_at > ttl_hours * 3600
+            oversized = max_size_mb is not None and total_size > max_size_mb * 1024 ** 2
+            if expired or oversized:
+                total_size -= sum(os.path.getsize(file_path) for file_path in file_paths)
+                for file_path in file_paths:
+                    os.remove(file_path)
+                index.pop(name, None)
+                evicted.append(name)
+
+        if len(evicted) > 0:
+            save_cache_index(index)
 
-def open_cache(name): 
-    file_path = get_cache_path(name)
-    compression_options = get_compression_options(name)
-    return pd.read_json(file_path, orient = "table", compression = compression_options)
+    return evicted
@@ -1,21 +1,162 @@
 from datetime import date, datetime, timedelta
 import hashlib
+import json
 import os
+import threading
+import numpy as np
 import pandas as pd
 
-def set_object_hash_key(df):
-    df["concat"] = df["workspace_server"].astype(str) + df["dataset_database"].astype(str) + df["table_name_raw"].astype(str) + df["object_name_raw"].astype(str) + df["object_type"].astype(str)
-    df["object_key"] = df["concat"].apply(lambda x: hashlib.md5(x.encode()).hexdigest())
+from core.cache import open_cache, save_cache
+from core.metrics import count_rows
+from core.miscellaneous import print_log
+from core.processing import IDENTIFIER_COLUMNS, get_identifiers, set_object_codes
 
-    df = df.drop(["concat"], axis = 1)
+STORAGE_HISTORY_COLUMNS = ["object_key", "dictionary_size", "used_size", "valid_from", "valid_to"]
+OBJECT_KEY_COLUMNS = ["workspace_server", "dataset_database", "table_name_raw", "object_name_raw", "object_type"]
 
-    return df
+object_key_registry = {}
+object_key_registry_lock = threading.Lock()
+
+def open_object_key_registry():
+    df_registry = open_cache("object_keys") if len(object_key_registry) == 0 else None
+    if df_registry is not None:
+        object_key_registry.update(zip(df_registry["object"].astype(str), df_registry["object_key"].astype(str)))
+
+    return object_key_registry
+
+def get_object_keys(df_objects, cache_configuration = None):
+    concat = df_objects["workspace_server"].astype(str) + df_objects["dataset_database"].astype(str) + df_objects["table_name_raw"].astype(str) + df_objects["object_name_raw"].astype(str) + df_objects["object_type"].astype(str)
+
+    with object_key_registry_lock:
+        registry = open_object_key_registry()
+        new_objects = [value for value in concat.drop_duplicates() if value not in registry]
+        registry.update((value, hashlib.md5(value.encode()).hexdigest()) for value in new_objects)
+
+        if len(new_objects) > 0 and cache_configuration is not None:
+            save_cache(pd.DataFrame({ "object": list(registry.keys()), "object_key": list(registry.values()) }), "object_keys", cache_configuration)
+
+    return concat.map(registry).to_numpy()
+
+def set_object_hash_key(df, cache_configuration = None):
+    # One hash per distinct object, broadcast back to the rows by a join
+    df_keys = df[OBJECT_KEY_COLUMNS].drop_duplicates()
+    df_keys = df_keys.assign(object_key = get_object_keys(df_keys, cache_configuration))
+
+    return df.drop(["object_key"], axis = 1, errors = "ignore").merge(df_keys, on = OBJECT_KEY_COLUMNS, how = "left")
 
 def get_output_path(export_name):
     return "output/{name}.csv".format(name = export_name)
 
-def export_output(df_export, export_name, partionned):
+def get_partition_directory(export_name):
+    return "output/{name}".format(name = export_name)
+
+def get_partition_path(export_name, date_key, output_format):
+    return "output/{name}/date_key={date_key}.{output_format}".format(name = export_name, date_key = date_key, output_format = output_format)
+
+def get_partition_manifest_path(export_name):
+    return "output/{name}/manifest.json".format(name = export_name)
+
+def is_partitioned_layout(output_configuration):
+    return output_configuration is not None and output_configuration.get("layout", "file") == "partitioned"
+
+def open_partition_manifest(export_name):
+    file_path = get_partition_manifest_path(export_name)
+    if not os.path.isfile(file_path):
+        return { "partitions": {} }
+
+    with open(file_path) as f:
+        return json.load(f)
+
+def save_partition_manifest(manifest, export_name):
+    manifest["max_date_key"] = max(manifest["partitions"]) if len(manifest["partitions"]) > 0 else None
+    with open(get_partition_manifest_path(export_name), "w") as f:
+        json.dump(manifest, f, indent = 2, sort_keys = True)
+
+def remove_output_partition(export_name, date_key, manifest):
+    for output_format in ["csv", "parquet"]:
+        path = get_partition_path(export_name, date_key, output_format)
+        if os.path.isfile(path):
+            os.remove(path)
+    manifest["partitions"].pop(date_key, None)
+
+def write_output_partitions(df_export, export_name, output_configuration, manifest):
+    output_format = output_configuration.get("format", "csv")
+    for date_key, df_partition in df_export.groupby("date_key", sort = True):
+        remove_output_partition(export_name, date_key, manifest)
+
+        path = get_partition_path(export_name, date_key, output_format)
+        temporary_path = "{path}.tmp".format(path = path)
+        if output_format == "parquet":
+            df_partition.to_parquet(temporary_path, index = False)
+        else:
+            df_partition.to_csv(temporary_path, index = False)
+        os.replace(temporary_path, path)
+
+        manifest["partitions"][date_key] = { "rows": len(df_partition), "format": output_format }
+
+    return df_export["date_key"].drop_duplicates().tolist()
+
+def open_output_partition_store(export_name):
+    os.makedirs(get_partition_directory(export_name), exist_ok = True)
+    manifest = open_partition_manifest(export_name)
+
+    # First partitioned export: the existing single file is split once into partitions
     path = get_output_path(export_name)
+    if len(manifest["partitions"]) == 0 and os.path.isfile(path):
+        write_output_partitions(pd.read_csv(path), export_name, { "format": "csv" }, manifest)
+        save_partition_manifest(manifest, export_name)
+
+    return manifest
+
+def export_output_partitions(chunks, export_name, partitions, output_configuration):
+    manifest = open_output_partition_store(export_name)
+
+    written_partitions = set()
+    for df_chunk in chunks:
+        written_partitions.update(write_output_partitions(df_chunk, export_name, output_configuration, manifest))
+        save_partition_manifest(manifest, export_name)
+
+    for date_key in set(partitions) - written_partitions:
+        remove_output_partition(export_name, date_key, manifest)
+    # Partitions written or removed by the last export, the merge of the shards only rewrites those
+    manifest["exported_partitions"] = sorted(set(partitions) | written_partitions)
+    save_partition_manifest(manifest, export_name)
+
+def get_output_max_date(export_name, output_configuration = None):
+    if is_partitioned_layout(output_configuration):
+        return open_output_partition_store(export_name).get("max_date_key")
+
+    path = get_output_path(export_name)
+    if not os.path.isfile(path):
+        return None
+
+    return pd.read_csv(path, usecols = ["date_key"])["date_key"].max()
+
+def compact_output(export_name):
+    manifest = open_partition_manifest(export_name)
+    path = get_output_path(export_name)
+    temporary_path = "{path}.tmp".format(path = path)
+
+    header = True
+    for date_key in sorted(manifest["partitions"]):
+        partition_path = get_partition_path(export_name, date_key, manifest["partitions"][date_key]["format"])
+        if manifest["partitions"][date_key]["format"] == "parquet":
+            df_partition = pd.read_parquet(partition_path)
+        else:
+            df_partition = pd.read_csv(partition_path)
+
+        df_partition.to_csv(temporary_path, index = False, header = header, mode = "w" if header else "a")
+        header = False
+
+    if not header:
+        os.replace(temporary_path, path)
+
+def export_output(df_export, export_name, partionned, output_configuration = None):
+    path = get_output_path(export_name)
+    if partionned and is_partitioned_layout(output_configuration):
+        export_output_partitions([df_export], export_name, df_export["date_key"].drop_duplicates().tolist(), output_configuration)
+        return
+
     if partionned:
         export_partitions = df_export["date_key"].drop_duplicates().to_numpy()
         if os.path.isfile(path):
@@ -27,45 +168,73 @@ def export_output(df_export, export_name, partionned):
         df_export = df_export.sort_values(by = "date_key")
     df_export.to_csv(path, index = False)
 
-def get_output_objects(df_objects):
-    df_output_object = set_object_hash_key(df_objects)
+def export_output_chunks(chunks, export_name, partitions, output_configuration = None):
+    if is_partitioned_layout(output_configuration):
+        export_output_partitions(chunks, export_name, partitions, output_configuration)
+        return
+
+    path = get_output_path(export_name)
+    temporary_path = "{path}.tmp".format(path = path)
+    first_partition = min(partitions)
+    header = True
+
+    def write(df):
+        nonlocal header
+        df.to_csv(temporary_path, index = False, header = header, mode = "w" if header else "a")
+        header = False
+
+    def get_source_chunks(before_partitions):
+        if os.path.isfile(path):
+            for df_source in pd.read_csv(path, chunksize = 1000000):
+                df_source = df_source[((df_source["date_key"] < first_partition) == before_partitions) & ~df_source["date_key"].isin(partitions)]
+                if len(df_source) > 0:
+                    yield df_source
+
+    # The existing file is sorted by date: rows before the exported partitions, the new partitions, then the rest
+    for df_source in get_source_chunks(True):
+        write(df_source)
+
+    for df_chunk in chunks:
+        write(df_chunk.sort_values(by = "date_key"))
+
+    for df_source in get_source_chunks(False):
+        write(df_source)
+
+    if not header:
+        os.replace(temporary_path, path)
+
+def get_output_objects(df_objects, cache_configuration = None):
+    df_output_object = set_object_hash_key(df_objects, cache_configuration)
 
     df_output_object = df_output_object[["object_key", "workspace_server", "dataset_database", "object_type", "table_name_raw", "object_name_raw"]]
     df_output_object = df_output_object.rename(columns = {"table_name_raw" : "table_name", "object_name_raw" : "object_name"})
 
     return df_output_object
 
-def get_output_usage_by_object(df_parsed_queries, df_objects, df_dependencies):
-    first_date = datetime.strptime(df_parsed_queries["date_key"].min(), "%Y-%m-%d")
-    last_date = datetime.strptime(df_parsed_queries["date_key"].max(), "%Y-%m-%d")
-    df_dates = pd.DataFrame({ "date_key": pd.date_range(start = first_date, end = last_date) })
-    df_dates["date_key"] = df_dates["date_key"].astype(str)
+def get_usage_dates(df_parsed_queries, date_range = None):
+    if date_range is None and len(df_parsed_queries) == 0:
+        return []
 
-    df_objects = df_objects.drop(["query", "table_id", "object_id"], axis = 1)  
+    first_date, last_date = date_range or (df_parsed_queries["date_key"].min(), df_parsed_queries["date_key"].max())
+    first_date = datetime.strptime(first_date, "%Y-%m-%d")
+    last_date = datetime.strptime(last_date, "%Y-%m-%d")
 
-    df_output_object = pd.merge(df_dates, df_objects, how = "cross")
-    df_output_object = pd.merge(df_output_object, df_parsed_queries
-                                , on = ["workspace_server", "dataset_database", "table_name", "object_name", "date_key"]
-                                , how = "left")
-    
-    df_output_object = df_output_object.drop(["query_id"], axis = 1)
-    df_output_object = df_output_object.rename(columns = { "count_call": "direct_number_of_execution", "count_query": "direct_number_of_queries" })
+    return pd.date_range(start = first_date, end = last_date).astype(str).tolist()
+
+def get_indirect_usage(df_parsed_queries, df_objects, df_dependencies):
+    df_direct_usage = pd.merge(df_objects[["object_code"]], df_parsed_queries[["object_code", "date_key", "count_call"]], on = "object_code", how = "inner")
+
+    df_dependencies_usage = df_dependencies[["object_code", "referenced_object_code"]].merge(df_direct_usage, on = "object_code", how = "inner")
+    df_dependencies_usage = df_dependencies_usage.groupby(["date_key", "referenced_object_code"], as_index = False).agg({"count_call" : "sum"})
+    df_dependencies_usage = df_dependencies_usage.rename(columns = { "count_call" : "indirect_number_of_execution", "referenced_object_code" : "object_code" })
 
-    df_dependencies_usage = df_dependencies.merge(df_output_object
-                                                  , on = ["workspace_server", "dataset_database", "table_name", "object_name"]
-                                                  , how = "inner"
-                                                  )
-    df_dependencies_usage = df_dependencies_usage.drop(["object_type_x", "object_type_y", "table_name_raw", "object_name_raw"], axis = 1)
-    df_dependencies_usage = df_dependencies_usage.groupby(["workspace_server", "dataset_database", "date_key", "referenced_table", "referenced_object"], as_index = False).agg({"direct_number_of_execution" : "sum"})
-    df_dependencies_usage = df_dependencies_usage.rename(columns = { "direct_number_of_execution" : "indirect_number_of_execution", "referenced_table" : "table_name", "referenced_object" : "object_name"})
+    return df_dependencies_usage
 
-    df_output_object = df_output_object.merge(df_dependencies_usage
-                                              , on = ["workspace_server", "dataset_database", "table_name", "object_name", "date_key"]
-                                              , how = "left"
-                                              )
-    df_output_object = df_output_object.rename(columns = { "object_type_x" : "object_type"})
+def get_usage_for_grid(df_grid, df_parsed_queries, df_dependencies_usage):
+    df_output_object = pd.merge(df_grid, df_parsed_queries[["object_code", "date_key", "count_query", "count_call"]], on = ["object_code", "date_key"], how = "left")
+    df_output_object = df_output_object.rename(columns = { "count_call": "direct_number_of_execution", "count_query": "direct_number_of_queries" })
 
-    df_output_object = set_object_hash_key(df_output_object)
+    df_output_object = df_output_object.merge(df_dependencies_usage, on = ["object_code", "date_key"], how = "left")
 
     df_output_object = df_output_object.fillna(0)
     df_output_object = df_output_object[["date_key", "object_key", "direct_number_of_queries", "direct_number_of_execution", "indirect_number_of_execution"]]
@@ -73,15 +242,50 @@ def get_output_usage_by_object(df_parsed_queries, df_objects, df_dependencies):
 
     return df_output_object
 
+def get_output_usage_by_object_chunks(df_parsed_queries, df_objects, df_dependencies, sparse = False, chunk_days = None, cache_configuration = None, date_range = None):
+    # Names are only carried by the identifiers, the grid holds the object codes and keys
+    df_identifiers = get_identifiers(df_objects)
+    dates = get_usage_dates(df_parsed_queries, date_range)
+    df_objects = set_object_hash_key(df_identifiers, cache_configuration)[["object_code", "object_key"]]
+    df_parsed_queries = set_object_codes(df_parsed_queries[IDENTIFIER_COLUMNS + ["date_key", "count_query", "count_call"]], df_identifiers)[["object_code", "date_key", "count_query", "count_call"]]
+    df_dependencies = set_object_codes(df_dependencies, df_identifiers)
+    df_dependencies = set_object_codes(df_dependencies, df_identifiers, ["workspace_server", "dataset_database", "referenced_table", "referenced_object"], "referenced_object_code")
+    df_dependencies_usage = get_indirect_usage(df_parsed_queries, df_objects, df_dependencies)
 
-def get_output_storage(df_storage, df_parsed_queries):
-    path = get_output_path("storage")
-    if not os.path.isfile(path):
-        first_date = datetime.strptime(df_parsed_queries["date_key"].min(), "%Y-%m-%d")
-        last_date = datetime.strptime(df_parsed_queries["date_key"].max(), "%Y-%m-%d")
+    if sparse:
+        # Only the (object, date) pairs with a direct or an indirect usage
+        df_direct_grid = pd.merge(df_objects, df_parsed_queries[["object_code", "date_key"]], on = "object_code", how = "inner")
+        df_indirect_grid = pd.merge(df_objects, df_dependencies_usage[["object_code", "date_key"]], on = "object_code", how = "inner")
+        df_grid = pd.concat([df_direct_grid, df_indirect_grid]).drop_duplicates().sort_values(by = "date_key")
+
+        yield get_usage_for_grid(df_grid, df_parsed_queries, df_dependencies_usage)
+        return
+
+    chunk_days = len(dates) if chunk_days is None else chunk_days
+    for index in range(0, len(dates), chunk_days):
+        chunk_dates = dates[index:index + chunk_days]
+        df_dates = pd.DataFrame({ "date_key": chunk_dates })
+        df_grid = pd.merge(df_dates, df_objects, how = "cross")
+
+        yield get_usage_for_grid(df_grid
+                                 , df_parsed_queries[df_parsed_queries["date_key"].isin(chunk_dates)]
+                                 , df_dependencies_usage[df_dependencies_usage["date_key"].isin(chunk_dates)])
+
+def get_output_usage_by_object(df_parsed_queries, df_objects, df_dependencies, sparse = False, cache_configuration = None):
+    return pd.concat(get_output_usage_by_object_chunks(df_parsed_queries, df_objects, df_dependencies, sparse, cache_configuration = cache_configuration), ignore_index = True)
+
+
+def get_output_storage(df_storage, df_parsed_queries, output_configuration = None, cache_configuration = None):
+    max_date_key = get_output_max_date("storage", output_configuration)
+    usage_dates = get_usage_dates(df_parsed_queries, (output_configuration or {}).get("date_range"))
+    if max_date_key is None and len(usage_dates) == 0:
+        # Without any audited query the snapshot starts today
+        first_date = last_date = datetime.now().date()
+    elif max_date_key is None:
+        first_date = datetime.strptime(usage_dates[0], "%Y-%m-%d")
+        last_date = datetime.strptime(usage_dates[-1], "%Y-%m-%d")
     else:
-        df_source = pd.read_csv(path)
-        first_date = (datetime.strptime(df_source["date_key"].max(), "%Y-%m-%d") + timedelta(days = 1)).date()
+        first_date = (datetime.strptime(max_date_key, "%Y-%m-%d") + timedelta(days = 1)).date()
         last_date = datetime.now().date()
 
     if last_date < first_date:
@@ -90,11 +294,104 @@ def get_output_storage(df_storage, df_parsed_queries):
     df_dates = pd.DataFrame({ "date_key": pd.date_range(start = first_date, end = last_date) })
     df_dates["date_key"] = df_dates["date_key"].astype(str)
 
-    df_output_storage = pd.merge(df_dates, df_storage, how = "cross")
-    df_output_storage = set_object_hash_key(df_output_storage)
+    df_output_storage = pd.merge(df_dates, set_object_hash_key(df_storage, cache_configuration), how = "cross")
 
     df_output_storage = df_output_storage.fillna(0)
     df_output_storage = df_output_storage[["date_key", "object_key", "dictionary_size", "used_size"]]
     df_output_storage = df_output_storage.astype({ "used_size" : "int", "dictionary_size" : "int" })
 
-    return df_output_storage
\ No newline at end of file
+    return df_output_storage
+
+def open_storage_history():
+    path = get_output_path("storage_history")
+    if not os.path.isfile(path):
+        return pd.DataFrame({ column: pd.Series(dtype = "int64" if column.endswith("_size") else object) for column in STORAGE_HISTORY_COLUMNS })
+
+    return pd.read_csv(path, dtype = { "object_key": str, "valid_from": str, "valid_to": str })
+
+def save_storage_history(df_history):
+    path = get_output_path("storage_history")
+    temporary_path = "{path}.tmp".format(path = path)
+    df_history.to_csv(temporary_path, index = False)
+    os.replace(temporary_path, path)
+
+def get_storage_history(df_storage, df_history, valid_from, cache_configuration = None):
+    df_current = set_object_hash_key(df_storage, cache_configuration).fillna(0)
+    df_current = df_current[["object_key", "dictionary_size", "used_size"]].drop_duplicates("object_key")
+    df_current = df_current.astype({ "used_size" : "int64", "dictionary_size" : "int64" })
+
+    df_closed = df_history[df_history["valid_to"].notnull()]
+    df_open = df_history[df_history["valid_to"].isnull()].drop(["valid_to"], axis = 1)
+    df_open = df_open.merge(df_current, on = "object_key", how = "outer", suffixes = ("", "_current"), indicator = True)
+
+    unchanged = (df_open["_merge"] == "both") & (df_open["dictionary_size"] == df_open["dictionary_size_current"]) & (df_open["used_size"] == df_open["used_size_current"])
+    df_unchanged = df_open[unchanged]
+
+    # Rows opened earlier the same day are replaced instead of closed with an empty validity
+    df_ended = df_open[~unchanged & (df_open["_merge"] != "right_only") & (df_open["valid_from"] != valid_from)]
+    df_ended = df_ended.assign(valid_to = (datetime.strptime(valid_from, "%Y-%m-%d") - timedelta(days = 1)).strftime("%Y-%m-%d"))
+
+    df_started = df_open[~unchanged & (df_open["_merge"] != "left_only")]
+    df_started = df_started.assign(dictionary_size = df_started["dictionary_size_current"], used_size = df_started["used_size_current"], valid_from = valid_from)
+
+    df_history = pd.concat([df_closed, df_unchanged, df_ended, df_started])[STORAGE_HISTORY_COLUMNS]
+    df_history = df_history.astype({ "used_size" : "int64", "dictionary_size" : "int64" })
+
+    return df_history.sort_values(by = ["object_key", "valid_from"]).reset_index(drop = True)
+
+def get_storage_at(df_history, date_key):
+    valid = (df_history["valid_from"] <= date_key) & (df_history["valid_to"].isnull() | (df_history["valid_to"] >= date_key))
+
+    return df_history[valid].assign(date_key = date_key)[["date_key", "object_key", "dictionary_size", "used_size"]].reset_index(drop = True)
+
+def get_daily_storage(df_history, first_date = None, last_date = None):
+    first_date = pd.Timestamp(df_history["valid_from"].min() if first_date is None else first_date)
+    last_date = pd.Timestamp(datetime.now().date() if last_date is None else last_date)
+
+    valid_from = pd.to_datetime(df_history["valid_from"]).clip(lower = first_date)
+    valid_to = pd.to_datetime(df_history["valid_to"].fillna(last_date.strftime("%Y-%m-%d"))).clip(upper = last_date)
+    days = ((valid_to - valid_from).dt.days + 1).clip(lower = 0).to_numpy()
+
+    # One row per valid day: each interval is repeated and offset by its position within the interval
+    offsets = np.arange(days.sum()) - np.repeat(np.cumsum(days) - days, days)
+    date_keys = pd.DatetimeIndex(np.repeat(valid_from.to_numpy(), days) + offsets * np.timedelta64(1, "D")).strftime("%Y-%m-%d")
+
+    df_daily = df_history.loc[df_history.index.repeat(days), ["object_key", "dictionary_size", "used_size"]]
+    df_daily.insert(0, "date_key", date_keys)
+
+    return df_daily.sort_values(by = ["date_key", "object_key"], kind = "stable").reset_index(drop = True)
+
+def export_objects(df_objects, cache_configuration):
+    df_output_objects = get_output_objects(df_objects, cache_configuration)
+    export_output(df_output_objects, "objects", False)
+
+    return df_output_objects
+
+def export_storage(df_storage, df_parsed_queries, output_configuration, cache_configuration):
+    if output_configuration.get("storage_mode", "snapshot") == "history":
+        # The first run starts the history with the oldest audited date, as the snapshot mode does
+        df_history = open_storage_history()
+        usage_dates = get_usage_dates(df_parsed_queries, output_configuration.get("date_range"))
+        valid_from = usage_dates[0] if len(df_history) == 0 and len(usage_dates) > 0 else datetime.now().strftime("%Y-%m-%d")
+        df_history = get_storage_history(df_storage, df_history, valid_from, cache_configuration)
+        save_storage_history(df_history)
+
+        return df_history
+
+    df_output_storage = get_output_storage(df_storage, df_parsed_queries, output_configuration, cache_configuration)
+    export_output(df_output_storage, "storage", True, output_configuration)
+
+    return df_output_storage
+
+def export_usage_by_objects(df_parsed_queries, df_objects, df_dependencies, output_configuration, cache_configuration):
+    usage_dates = get_usage_dates(df_parsed_queries, output_configuration.get("date_range"))
+    if len(usage_dates) == 0:
+        print_log("No query found on the objects of the scope, the usage export is skipped", 30)
+        return 0
+
+    usage_by_object_chunks = get_output_usage_by_object_chunks(df_parsed_queries, df_objects, df_dependencies, output_configuration.get("usage_mode", "dense") == "sparse", output_configuration.get("chunk_days"), cache_configuration, output_configuration.get("date_range"))
+
+    record = {}
+    export_output_chunks(count_rows(usage_by_object_chunks, record), "usage_by_objects", usage_dates, output_configuration)
+
+    return record["output_rows"]
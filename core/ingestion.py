@@ -1,12 +1,13 @@
 import os
-import re
+import threading
+import time
 import pandas as pd
-from pyadomd import Pyadomd
-from datetime import datetime, timezone
-from azure.identity import DefaultAzureCredential
-from azure.monitor.query import LogsQueryClient, LogsQueryStatus
-from azure.core.exceptions import HttpResponseError
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from core.cache import cache_is_available, open_cache, open_manifest, save_manifest
 from core.miscellaneous import print_log
+from core.processing import get_query_usage, merge_query_usage
+from core.recording import LOGS_QUERY_STATUSES, RecordingConnection, RecordingLogsQueryClient, ReplayConnection, ReplayLogsQueryClient, get_data_source_mode
 
 def set_auth_environment_variables(configuration):
     os.environ["AZURE_TENANT_ID"] = configuration["azure"]["tenant_id"]
@@ -14,41 +15,163 @@ def set_auth_environment_variables(configuration):
     os.environ["AZURE_CLIENT_SECRET"] = configuration["azure"]["secret_key"]
 
 # Azure logs analytics 
-def execute_azure_log_analytics_query(query, worspace_id): 
-    start_time = datetime(1900, 1, 1, tzinfo = timezone.utc)
-    end_time = datetime(9999, 12, 31, tzinfo = timezone.utc)
+def get_log_analytics_client():
+    if get_data_source_mode() == "replay":
+        return ReplayLogsQueryClient()
+
+    # The Azure SDKs are only loaded by the stages which query Log Analytics
+    from azure.identity import DefaultAzureCredential
+    from azure.monitor.query import LogsQueryClient
 
     credential = DefaultAzureCredential()
     client = LogsQueryClient(credential)
 
-    try:
-        response = client.query_workspace(
-            workspace_id = worspace_id,
-            query = query,
-            timespan = (start_time, end_time)
-            )
-        if response.status == LogsQueryStatus.PARTIAL:
-            data = response.partial_data
-            print_log("Partial query", 30)
-            print_log(response.partial_error, 30)
+    return RecordingLogsQueryClient(client) if get_data_source_mode() == "record" else client
+
+def get_retry_options(configuration):
+    return dict(max_retries = configuration["log_analytics"].get("max_retries", 5), retry_delay = configuration["log_analytics"].get("retry_delay", 1))
+
+def get_service_errors(client):
+    # Only the clients calling the service raise its errors, a replay never loads the Azure SDK
+    if isinstance(client, ReplayLogsQueryClient):
+        return ()
+
+    from azure.core.exceptions import HttpResponseError
+
+    return (HttpResponseError,)
+
+def get_log_analytics_response(query, worspace_id, client = None, max_retries = 0, retry_delay = 1):
+    start_time = datetime(1900, 1, 1, tzinfo = timezone.utc)
+    end_time = datetime(9999, 12, 31, tzinfo = timezone.utc)
+
+    if client is None:
+        client = get_log_analytics_client()
+    service_errors = get_service_errors(client)
+
+    attempt = 0
+    while True:
+        try:
+            return client.query_workspace(
+                workspace_id = worspace_id,
+                query = query,
+                timespan = (start_time, end_time)
+                )
+
+        except service_errors as err:
+            if err.status_code == 429 and attempt < max_retries:
+                delay = retry_delay * 2 ** attempt
+                print_log("Throttled by Azure Log Analytics, retry {attempt}/{max_retries} in {delay}s".format(attempt = attempt + 1, max_retries = max_retries, delay = delay), 30)
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            print_log(err, 50)
+            exit(1)
+
+def is_partial_response(response):
+    return response.status == LOGS_QUERY_STATUSES["PARTIAL"]
+
+def get_response_data(response):
+    if is_partial_response(response):
+        return response.partial_data
+
+    return response.tables
+
+def execute_azure_log_analytics_query(query, worspace_id, client = None, max_retries = 0, retry_delay = 1): 
+    response = get_log_analytics_response(query, worspace_id, client, max_retries, retry_delay)
+
+    if is_partial_response(response):
+        print_log("Partial query", 30)
+        print_log(response.partial_error, 30)
+
+    for table in get_response_data(response):
+        df = pd.DataFrame(data = table.rows, columns = table.columns)
+        return df
+
+def get_window_options(configuration):
+    return dict(max_rows = configuration["log_analytics"].get("max_rows", 500000)
+                , split_factor = configuration["log_analytics"].get("split_factor", 4)
+                , min_window = timedelta(minutes = configuration["log_analytics"].get("min_window_minutes", 1)))
+
+def merge_log_analytics_windows(windows):
+    df = pd.concat(windows, ignore_index = True)
+    keys = [column for column in df.columns if column != "count"]
+
+    return df.groupby(keys, as_index = False, sort = False, dropna = False)["count"].sum()
+
+def execute_azure_log_analytics_window(query_template, partition, start, end, worspace_id, client, semaphore, retry_options, window_options):
+    query = query_template.format(partition = partition, start = start.strftime("%Y-%m-%dT%H:%M:%SZ"), end = end.strftime("%Y-%m-%dT%H:%M:%SZ"))
+    with semaphore:
+        response = get_log_analytics_response(query, worspace_id, client, **retry_options)
+
+    df = None
+    for table in get_response_data(response):
+        df = pd.DataFrame(data = table.rows, columns = table.columns)
+        break
+
+    # A partial answer or a full page means rows were cut by the service limits
+    truncated = is_partial_response(response) or (df is not None and len(df) >= window_options["max_rows"])
+    if not truncated:
+        return df
+
+    step = (end - start) / window_options["split_factor"]
+    if step < window_options["min_window"]:
+        print_log("Partial query for partition '{partition}' between {start} and {end}, the window can't be split further".format(partition = partition, start = start, end = end), 30)
+        return df
+
+    print_log("Partition '{partition}' is too large between {start} and {end}, split into {count} windows".format(partition = partition, start = start, end = end, count = window_options["split_factor"]))
+    bounds = [start + step * index for index in range(window_options["split_factor"])] + [end]
+
+    def execute_window(window):
+        return execute_azure_log_analytics_window(query_template, partition, window[0], window[1], worspace_id, client, semaphore, retry_options, window_options)
+
+    with ThreadPoolExecutor(max_workers = window_options["split_factor"]) as executor:
+        windows = [df_window for df_window in executor.map(execute_window, zip(bounds[:-1], bounds[1:])) if df_window is not None]
+
+    if len(windows) == 0:
+        return None
+
+    return merge_log_analytics_windows(windows)
+
+def get_partition_start(partition):
+    return datetime.strptime(partition, "%Y-%m-%d-%H").replace(tzinfo = timezone.utc)
+
+def get_partition_end(partition):
+    return get_partition_start(partition) + timedelta(hours = 1)
+
+def get_incremental_state(configuration):
+    if not configuration["log_analytics"].get("incremental", False) or not cache_is_available("queries_raw"):
+        return None, {}
+
+    manifest = open_manifest("queries_raw")
+    if len(manifest) == 0:
+        return None, {}
 
-        elif response.status == LogsQueryStatus.SUCCESS:
-            data = response.tables
+    df_previous_queries = open_cache("queries_raw")
+    if df_previous_queries is None or "partition" not in df_previous_queries.columns:
+        return None, {}
 
-        for table in data:
-            df = pd.DataFrame(data = table.rows, columns = table.columns)
-            return df
+    # Partitions whose cached rows do not match the manifest are fetched again
+    cached_rows = df_previous_queries.groupby("partition").size().to_dict()
+    partitions = { partition: state for partition, state in manifest["partitions"].items() if cached_rows.get(partition, 0) == state["rows"] }
 
-    except HttpResponseError as err:
-        print_log(err, 50)
-        exit(1)
+    return df_previous_queries, partitions
 
+def get_watermark(configuration):
+    return datetime.now(timezone.utc) - timedelta(hours = configuration["log_analytics"].get("ingestion_delay", 1))
 
-def get_log_analytics_raw_queries(queries, configuration):
+def get_raw_queries_period(queries, configuration):
+    # In incremental mode the cached raw queries are completed every hour with the partitions closed since
+    if not configuration["log_analytics"].get("incremental", False):
+        return None
+
+    return get_watermark(configuration).strftime("%Y-%m-%d %H")
+
+def get_selected_partitions(queries, configuration, client):
     current_mode = configuration["mode"]
+    partitions = execute_azure_log_analytics_query(queries["azure_log_analytics"][current_mode]["get_available_partitions"], configuration["log_analytics"]["workspace_id"], client, **get_retry_options(configuration))
 
-    partitions = execute_azure_log_analytics_query(queries["azure_log_analytics"][current_mode]["get_available_partitions"], configuration["log_analytics"]["workspace_id"])
-    all_log_analytics_queries = None
+    selected_partitions = []
     for partition in partitions.partition:
         partition_date = datetime.strptime(partition[:10], "%Y-%m-%d")
         current_date = datetime.today()
@@ -56,88 +179,178 @@ def get_log_analytics_raw_queries(queries, configuration):
         if (current_date - partition_date).days > configuration["log_analytics"]["search_dept"]:
             continue
 
-        print_log("Get queries for partiton '{partition}'".format(partition = partition))
-        query = queries["azure_log_analytics"][current_mode]["get_queries"].format(partition = partition)
-        log_analytics_queries = execute_azure_log_analytics_query(query, configuration["log_analytics"]["workspace_id"])
+        selected_partitions.append(partition)
+
+    return selected_partitions
+
+def fetch_log_analytics_partitions(queries, configuration, client, partitions, reducer = None):
+    current_mode = configuration["mode"]
+    workspace_id = configuration["log_analytics"]["workspace_id"]
+    parallelism = configuration["log_analytics"].get("parallelism", 1)
+    retry_options = get_retry_options(configuration)
+    window_options = get_window_options(configuration)
+    window_query = queries["azure_log_analytics"][current_mode].get("get_queries_window")
+
+    # Split windows share the partition workers' budget of concurrent calls
+    semaphore = threading.BoundedSemaphore(max(1, parallelism))
 
-        if all_log_analytics_queries is None:
-            all_log_analytics_queries = log_analytics_queries
+    def get_partition_queries(partition):
+        print_log("Get queries for partiton '{partition}'".format(partition = partition))
+        if window_query is None:
+            query = queries["azure_log_analytics"][current_mode]["get_queries"].format(partition = partition)
+            df = execute_azure_log_analytics_query(query, workspace_id, client, **retry_options)
         else:
-            all_log_analytics_queries = pd.concat([all_log_analytics_queries, log_analytics_queries])
+            df = execute_azure_log_analytics_window(window_query, partition, get_partition_start(partition), get_partition_end(partition), workspace_id, client, semaphore, retry_options, window_options)
+        if df is None:
+            return None
+
+        df["partition"] = partition
+        if reducer is not None:
+            df = reducer(df)
+        return df
+
+    with ThreadPoolExecutor(max_workers = max(1, parallelism)) as executor:
+        return list(executor.map(get_partition_queries, partitions))
+
+def get_log_analytics_raw_queries(queries, configuration, client = None):
+    if client is None:
+        client = get_log_analytics_client()
+
+    selected_partitions = get_selected_partitions(queries, configuration, client)
+
+    df_previous_queries, manifest_partitions = get_incremental_state(configuration)
+    partitions_to_fetch = [partition for partition in selected_partitions if not manifest_partitions.get(partition, {}).get("closed", False)]
+    if df_previous_queries is not None:
+        print_log("Incremental mode: {count} of {total} partitions to fetch".format(count = len(partitions_to_fetch), total = len(selected_partitions)))
+
+    watermark = get_watermark(configuration)
+    fetched_queries = fetch_log_analytics_partitions(queries, configuration, client, partitions_to_fetch)
+
+    all_log_analytics_queries = []
+    if df_previous_queries is not None:
+        kept_partitions = set(selected_partitions) - set(partitions_to_fetch)
+        all_log_analytics_queries.append(df_previous_queries[df_previous_queries["partition"].isin(kept_partitions)])
+        manifest_partitions = { partition: state for partition, state in manifest_partitions.items() if partition in kept_partitions }
+
+    fetched_at = datetime.now(timezone.utc).isoformat()
+    for partition, df in zip(partitions_to_fetch, fetched_queries):
+        manifest_partitions[partition] = { "rows": 0 if df is None else len(df), "fetched_at": fetched_at, "closed": get_partition_end(partition) <= watermark }
+        if df is not None:
+            all_log_analytics_queries.append(df)
+
+    if len(all_log_analytics_queries) == 0:
+        return None
+
+    # Callers without cache settings, like the benchmarks, have no incremental state to keep
+    if configuration.get("cache") is not None:
+        save_manifest({ "watermark": watermark.isoformat(), "partitions": manifest_partitions }, "queries_raw", configuration["cache"])
+
+    return pd.concat(all_log_analytics_queries, ignore_index = True)
 
-    return all_log_analytics_queries
+def get_log_analytics_query_usage(queries, configuration, client = None):
+    if client is None:
+        client = get_log_analytics_client()
+
+    # Each partition is reduced to its usage aggregates by the worker that fetched it
+    selected_partitions = get_selected_partitions(queries, configuration, client)
+    partial_query_usage = [df for df in fetch_log_analytics_partitions(queries, configuration, client, selected_partitions, get_query_usage) if df is not None]
+
+    if len(partial_query_usage) == 0:
+        return None
+
+    return merge_query_usage(partial_query_usage)
 
 def get_available_scope(queries, configuration):
     current_mode = configuration["mode"]
-    return execute_azure_log_analytics_query(queries["azure_log_analytics"][current_mode]["get_scope"], configuration["log_analytics"]["workspace_id"])
+    return execute_azure_log_analytics_query(queries["azure_log_analytics"][current_mode]["get_scope"], configuration["log_analytics"]["workspace_id"], **get_retry_options(configuration))
 
 
 # Power BI & Azure Analysis Service
-def execute_dmv(df_scope, configuration, queries, query_name):
-    def get_column_matching(columns):
-        output = {}
-        index = 0
-        for column in columns:
-            output[index] = column
-            index += 1
-        return output
-
-    df_dmv = None
+MODEL_DMV_QUERIES = ["get_tables", "get_columns", "get_measures"]
+STORAGE_DMV_QUERIES = ["get_storage_dictionary", "get_storage_table_segments"]
 
+def get_connection_string(configuration, workspace, dataset):
     application_id = configuration["azure"]["application_id"]
     secret_key = configuration["azure"]["secret_key"]
     tenant_name = configuration["azure"]["tenant_name"]
     tenant_id = configuration["azure"]["tenant_id"]
-    
-    for index in df_scope.index:
-        workspace = df_scope["workspace_server"][index]
-        dataset = df_scope["dataset_database"][index]
 
-        query_config = queries["dmv"][query_name]
-        query = query_config["query"].format(workspace_server = workspace, dataset_database = dataset)
-        columns = query_config["columns"]
+    if(configuration["mode"] == "power_bi"):
+        return "Provider=MSOLAP;Data Source=powerbi://api.powerbi.com/v1.0/{tenant_name}/{workspace};catalog={dataset};User ID=app:{application_id}@{tenant_id};Password={secret_key}".format(application_id = application_id, secret_key = secret_key, tenant_name = tenant_name, tenant_id = tenant_id, workspace = workspace, dataset = dataset)
+    else:
+        # TODO
+        exit(0)
 
-        if(configuration["mode"] == "power_bi"):
-            connection_string = "Provider=MSOLAP;Data Source=powerbi://api.powerbi.com/v1.0/{tenant_name}/{workspace};catalog={dataset};User ID=app:{application_id}@{tenant_id};Password={secret_key}".format(application_id = application_id, secret_key = secret_key, tenant_name = tenant_name, tenant_id = tenant_id, workspace = workspace, dataset = dataset)
-        else:
-            # TODO
-            exit(0)
+def open_dmv_connection(connection_string):
+    if get_data_source_mode() == "replay":
+        return ReplayConnection(connection_string)
 
-        connection = Pyadomd(connection_string)
+    # Only live and record runs need the ADOMD client and its .NET runtime
+    from pyadomd import Pyadomd
 
-        try:
-            connection.open()
-        except:
-            if(configuration["mode"] == "power_bi"):
-                print_log("Connection failed to dataset '{tenant_name}/{workspace}/{dataset}' with provided SPN".format(tenant_name = tenant_name, workspace = workspace, dataset = dataset), 50)
-                exit(0)
-            else:
-                # TODO
-                exit(0)
-
-
-        result = connection.cursor().execute(query)
-        df_result = pd.DataFrame(result.fetchone())
+    connection = Pyadomd(connection_string)
+    connection.open()
+
+    return RecordingConnection(connection, connection_string) if get_data_source_mode() == "record" else connection
+
+def execute_dmv_session(workspace, dataset, connection_string, queries, query_names, connection_factory):
+    try:
+        connection = connection_factory(connection_string)
+    except Exception as err:
+        print_log("Connection failed to dataset '{workspace}/{dataset}' with provided SPN: {error}".format(workspace = workspace, dataset = dataset, error = err), 40)
+        return None
+
+    results = {}
+    try:
+        for query_name in query_names:
+            query_config = queries["dmv"][query_name]
+            query = query_config["query"].format(workspace_server = workspace, dataset_database = dataset)
+            result = connection.cursor().execute(query)
+            results[query_name] = pd.DataFrame(list(result.fetchone()), columns = query_config["columns"])
+    except Exception as err:
+        print_log("DMV query '{query_name}' failed on dataset '{workspace}/{dataset}': {error}".format(query_name = query_name, workspace = workspace, dataset = dataset, error = err), 40)
+        return None
+    finally:
         connection.close()
 
-        df_result.rename(columns = get_column_matching(columns), inplace = True)
+    return results
 
-        if df_dmv is None:
-            df_dmv = df_result
-        else:
-            df_dmv = pd.concat([df_dmv, df_result])
+def get_dmv_results(df_scope, configuration, queries, query_names, connection_factory = open_dmv_connection):
+    # One session per dataset runs every query of the stage, the sessions are closed when the stage is done
+    scope = list(dict.fromkeys(df_scope[["workspace_server", "dataset_database"]].itertuples(index = False, name = None)))
+    parallelism = configuration.get("dmv", {}).get("parallelism", 1)
+    connection_strings = [get_connection_string(configuration, workspace, dataset) for workspace, dataset in scope]
+
+    def get_session(arguments):
+        (workspace, dataset), connection_string = arguments
+        return execute_dmv_session(workspace, dataset, connection_string, queries, query_names, connection_factory)
 
-    return df_dmv
+    with ThreadPoolExecutor(max_workers = max(1, parallelism)) as executor:
+        sessions = list(executor.map(get_session, zip(scope, connection_strings)))
 
-def get_model_objects(df_scope, configuration, queries):
+    failed = len([results for results in sessions if results is None])
+    if len(scope) > 0 and failed == len(scope):
+        print_log("DMV queries failed for every one of the {total} datasets, check that the service principal has access to their workspaces".format(total = len(scope)), 40)
+    elif failed > 0:
+        print_log("DMV queries failed for {count} of {total} datasets, they are excluded from the audit".format(count = failed, total = len(scope)), 30)
+
+    dmv_results = {}
+    for query_name in query_names:
+        frames = [results[query_name] for results in sessions if results is not None]
+        dmv_results[query_name] = pd.concat(frames, ignore_index = True) if len(frames) > 0 else pd.DataFrame(columns = queries["dmv"][query_name]["columns"])
+
+    return dmv_results
+
+def get_model_objects(df_scope, configuration, queries, connection_factory = open_dmv_connection):
     def get_object_name(x):
         if(x["object_name"] is None):
             return x["object_alternative_name"]
         return x["object_name"]
 
-    df_tables = execute_dmv(df_scope, configuration, queries, "get_tables")
-    df_columns = execute_dmv(df_scope, configuration, queries, "get_columns")
-    df_measures = execute_dmv(df_scope, configuration, queries, "get_measures")
+    dmv_results = get_dmv_results(df_scope, configuration, queries, MODEL_DMV_QUERIES, connection_factory)
+    df_tables = dmv_results["get_tables"]
+    df_columns = dmv_results["get_columns"]
+    df_measures = dmv_results["get_measures"]
 
     df_columns["object_name"] = df_columns.apply(get_object_name, axis = 1)
 
@@ -154,26 +367,24 @@ def get_model_objects(df_scope, configuration, queries):
 
     return df_output
 
-def get_storage(df_scope, df_objects, configuration, queries):
-    def get_id_from_string(x):
-        column = "object_id"
-        if "table_id" in x.index.tolist() and re.match("^\S{1}\$", x["table_id"]):
-            column = "table_id"
+def get_id_from_string(df):
+    # Ids are read from the table id for system tables (H$, R$, U$...) and from the column id otherwise
+    ids = df["object_id"]
+    if "table_id" in df.columns:
+        ids = df["table_id"].where(df["table_id"].str.match(r"\S\$", na = False), ids)
 
-        matches = re.findall("\(([0-9]*)\)$", x[column])
-        if len(matches) == 0:
-            return 0
-        else:
-            return int(matches[0])
+    return pd.to_numeric(ids.str.extract(r"\(([0-9]*)\)$", expand = False), errors = "coerce").fillna(0).astype("int64")
 
-    df_storage_dictionary = execute_dmv(df_scope, configuration, queries, "get_storage_dictionary")
-    df_storage_table_segments = execute_dmv(df_scope, configuration, queries, "get_storage_table_segments")
+def get_storage(df_scope, df_objects, configuration, queries, connection_factory = open_dmv_connection):
+    dmv_results = get_dmv_results(df_scope, configuration, queries, STORAGE_DMV_QUERIES, connection_factory)
+    df_storage_dictionary = dmv_results["get_storage_dictionary"]
+    df_storage_table_segments = dmv_results["get_storage_table_segments"]
 
-    df_storage_dictionary["object_id"] = df_storage_dictionary.apply(get_id_from_string, axis = 1)
-    df_storage_table_segments["object_id"] = df_storage_table_segments.apply(get_id_from_string, axis = 1)
+    df_storage_dictionary["object_id"] = get_id_from_string(df_storage_dictionary)
+    df_storage_table_segments["object_id"] = get_id_from_string(df_storage_table_segments)
     
     df_storage_table_segments = df_storage_table_segments.drop(["table_id"], axis = 1)
-    df_storage_table_segments = df_storage_table_segments.groupby(["workspace_server", "dataset_database", "object_id"], as_index = False).sum("used_size")
+    df_storage_table_segments = df_storage_table_segments.groupby(["workspace_server", "dataset_database", "object_id"], as_index = False)["used_size"].sum()
 
     df_storage = df_objects.merge(df_storage_dictionary, on = ["workspace_server", "dataset_database", "object_id"], how = "left")
     df_storage = df_storage.merge(df_storage_table_segments, on = ["workspace_server", "dataset_database", "object_id"], how = "left")
@@ -0,0 +1,127 @@
+import cProfile
+import os
+import sys
+import time
+import tracemalloc
+import pandas as pd
+from contextlib import contextmanager
+from datetime import datetime
+
+metrics_configuration = { "enabled": True, "profile": [], "trace_memory": False }
+run_metrics = []
+run_id = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+def configure_metrics(configuration):
+    metrics_configuration.update(configuration)
+
+def get_metrics_directory():
+    return "metrics"
+
+def get_peak_rss():
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / 1024 ** 2 if sys.platform == "darwin" else peak_rss / 1024
+
+def get_rows(values):
+    return sum(len(value) for value in values if isinstance(value, pd.DataFrame))
+
+def profile_is_enabled(stage):
+    profile = metrics_configuration["profile"]
+    return profile is True or (isinstance(profile, list) and stage in profile)
+
+@contextmanager
+def resource_metrics(stage, record, measure_resources = True, profile = True):
+    profiler = None
+    if profile and profile_is_enabled(stage):
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    trace_memory = measure_resources and metrics_configuration["trace_memory"] and not tracemalloc.is_tracing()
+    if trace_memory:
+        tracemalloc.start()
+
+    start_cpu_time = time.process_time()
+    try:
+        yield record
+    finally:
+        # CPU time and memory are process wide, they would also count the other stages running in this process
+        if measure_resources:
+            record["cpu_time"] = round(time.process_time() - start_cpu_time, 3)
+
+            # Without tracing, the process high-water mark shows which stage raised the peak
+            if trace_memory:
+                record["peak_memory_mb"] = round(tracemalloc.get_traced_memory()[1] / 1024 ** 2, 1)
+                tracemalloc.stop()
+            else:
+                peak_rss = get_peak_rss()
+                record["peak_memory_mb"] = None if peak_rss is None else round(peak_rss, 1)
+        else:
+            record.setdefault("cpu_time", None)
+            record.setdefault("peak_memory_mb", None)
+
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(get_metrics_directory(), exist_ok = True)
+            profiler.dump_stats("{directory}/{run_id}_{stage}.prof".format(directory = get_metrics_directory(), run_id = run_id, stage = stage))
+
+@contextmanager
+def stage_metrics(stage, concurrent = False, in_worker = False, **inputs):
+    record = { "stage": stage, "cache": None, "input_rows": get_rows(inputs.values()), "output_rows": None }
+
+    # A stage sent to a worker process is measured by the worker, see execute_in_worker
+    start_time = time.perf_counter()
+    try:
+        with resource_metrics(stage, record, measure_resources = not concurrent and not in_worker, profile = not in_worker):
+            yield record
+    finally:
+        record["wall_time"] = round(time.perf_counter() - start_time, 3)
+
+        if metrics_configuration["enabled"]:
+            run_metrics.append(record)
+
+def execute_measured(function, stage, configuration, parent_run_id, args):
+    global run_id
+
+    # Spawned workers start with the default settings and their own run id
+    metrics_configuration.update(configuration)
+    run_id = parent_run_id
+
+    record = {}
+    with resource_metrics(stage, record):
+        output = function(**args)
+
+    return output, record
+
+def execute_in_worker(function, stage, executor, record, args):
+    output, measures = executor.submit(execute_measured, function, stage, dict(metrics_configuration), run_id, args).result()
+    record.update(measures)
+
+    return output
+
+def count_rows(chunks, record):
+    record["output_rows"] = 0
+    for df_chunk in chunks:
+        record["output_rows"] += len(df_chunk)
+        yield df_chunk
+
+def save_run_metrics():
+    if not metrics_configuration["enabled"] or len(run_metrics) == 0:
+        return None
+
+    os.makedirs(get_metrics_directory(), exist_ok = True)
+    df_metrics = pd.DataFrame(run_metrics, columns = ["stage", "cache", "wall_time", "cpu_time", "peak_memory_mb", "input_rows", "output_rows"])
+    df_metrics.insert(0, "run_id", run_id)
+
+    path = "{directory}/{run_id}".format(directory = get_metrics_directory(), run_id = run_id)
+    df_metrics.to_csv("{path}.csv".format(path = path), index = False)
+    df_metrics.to_json("{path}.json".format(path = path), orient = "records", indent = 2)
+
+    return df_metrics
+
+def get_run_metrics_summary():
+    df_metrics = pd.DataFrame(run_metrics, columns = ["stage", "cache", "wall_time", "cpu_time", "peak_memory_mb", "input_rows", "output_rows"])
+    return df_metrics.fillna("-").to_string(index = False).split("\n")
@@ -1,6 +1,7 @@
 import logging
 
-from core.cache import cache_is_available, open_cache, save_cache
+from core.metrics import execute_in_worker, stage_metrics
+from core.cache import cache_entry_is_valid, cache_index_lock, cache_is_available, evict_cache, get_cache_entry, get_frame_fingerprint, get_stage_key, open_cache, save_cache, save_cache_entry, touch_cache_entry
 
 DEBUG_LEVEL_PRINT = 25 
 logging.addLevelName(25, "INFO")
@@ -11,22 +12,46 @@ logging.Logger.print = logging_print
 logging.basicConfig(format = "[%(asctime)s] [%(levelname)s] [%(message)s]", datefmt = "%Y-%m-%d %H:%M:%S", level = 25)
 
 def print_log(message, level = DEBUG_LEVEL_PRINT):
-    l = logging.getLogger()
-    l.setLevel(level)
-    l.log(level, message)
+    logging.getLogger().log(level, message)
 
-def process_or_get_from_cache(function, cache_configuration, cache_name, cache_parameter, **args):
+def process_or_get_from_cache(function, cache_configuration, cache_name, cache_parameter, executor = None, concurrent = False, settings = None, period = None, **args):
+    with stage_metrics(cache_name, concurrent = concurrent, in_worker = executor is not None, **args) as metrics:
+        df_output = get_from_cache_or_process(function, cache_configuration, cache_name, cache_parameter, metrics, executor, settings, period, **args)
+        metrics["output_rows"] = None if df_output is None else len(df_output)
+    return df_output
+
+def get_from_cache_or_process(function, cache_configuration, cache_name, cache_parameter, metrics, executor, settings, period, **args):
     df_output = None
-    if cache_is_available(cache_name) and cache_configuration[cache_parameter]:
+    cache_key = get_stage_key(function, args, settings, period)
+    cache_entry = get_cache_entry(cache_name)
+
+    if cache_is_available(cache_name) and cache_configuration[cache_parameter] and cache_entry_is_valid(cache_entry, cache_key, cache_configuration):
         print_log("Get data from cache")
         df_output = open_cache(cache_name)
+        if df_output is None:
+            print_log("Cache was evicted before it could be read", 30)
+
+    if df_output is not None:
+        metrics["cache"] = "hit"
+        df_output.attrs["fingerprint"] = cache_entry["fingerprint"]
+        touch_cache_entry(cache_name, cache_configuration)
     else:
+        if cache_is_available(cache_name) and cache_configuration[cache_parameter]:
+            print_log("Cache is outdated or its inputs changed", 30)
+
         print_log("Start operation")
-        df_output = function(**args)
+        metrics["cache"] = "miss" if cache_configuration[cache_parameter] else "disabled"
+        df_output = function(**args) if executor is None else execute_in_worker(function, cache_name, executor, metrics, args)
         if(df_output is None):
             print_log("Operation done with error", 40)
             print_log("The dataframe is empty. The cache can't be saved", 40)
         else:
-            save_cache(df_output, cache_name, cache_configuration)
+            df_output.attrs["fingerprint"] = get_frame_fingerprint(df_output)
+            with cache_index_lock:
+                save_cache(df_output, cache_name, cache_configuration)
+                save_cache_entry(cache_name, cache_key, df_output.attrs["fingerprint"], cache_configuration)
+                evicted_cache_names = evict_cache(cache_configuration, keep = cache_name)
+            for evicted_cache_name in evicted_cache_names:
+                print_log("Cache '{name}' evicted".format(name = evicted_cache_name))
             print_log("Operation done")
     return df_output
\ No newline at end of file
@@ -1,60 +1,228 @@
 
-import re
 import hashlib
+import multiprocessing
+import os
+import threading
+import time
 import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from core.cache import open_cache, open_manifest, save_cache, save_manifest
 from core.miscellaneous import print_log
 
-def get_table_name(x):
-    if(type(x["data"]) is dict and x["data"]["table_name"] is not None):
-        return x["data"]["table_name"].upper()
-    return None
-
-def get_object_name(x):
-    if(type(x["data"]) is dict and x["data"]["object_name"] is not None):
-        return x["data"]["object_name"].upper()
-    return None
-
-def get_used_columns(row):
-    regex = "[^&\.]\[([^]]*?)\]\.\[(.*?)\]|'([^']*?)'\[(.*?)\]|([\w_]+)\[(.*?)\]|[^&\.]\[(.*?)\]"
-    result = []
-    matches = re.findall(regex, row["query"])
-
-    for match in matches:
-        table_name = None
-        object_name = None
-
-        if match[0] != "":
-            table_name = match[0]
-            object_name = match[1]
-        elif match[2] != "":
-            table_name = match[2]
-            object_name = match[3]   
-        elif match[4] != "":
-            table_name = match[4]
-            object_name = match[5]   
-        else:
-            object_name = match[6]
-        
-        result.append({"table_name": table_name, "object_name": object_name})
-
-    return result
+IDENTIFIER_COLUMNS = ["workspace_server", "dataset_database", "table_name", "object_name"]
+USED_COLUMNS_REGEX = r"[^&\.]\[([^]]*?)\]\.\[(.*?)\]|'([^']*?)'\[(.*?)\]|([\w_]+)\[(.*?)\]|[^&\.]\[(.*?)\]"
 
-def get_model_dependencies(df_objects):
-    print_log("Calculate direct dependencies")
+# Stored parse results are only valid for the expression that produced them
+PARSE_STORE_VERSION = hashlib.md5(USED_COLUMNS_REGEX.encode()).hexdigest()
+PARSE_STORE_COLUMNS = ["text_hash", "table_name", "object_name", "last_used"]
+
+parse_store_lock = threading.Lock()
+
+def get_used_columns(queries):
+    df_matches = queries.str.extractall(USED_COLUMNS_REGEX).fillna("")
+
+    table_name = df_matches[0].where(df_matches[0] != "", df_matches[2].where(df_matches[2] != "", df_matches[4].where(df_matches[4] != "")))
+    object_name = df_matches[1].where(df_matches[0] != "", df_matches[3].where(df_matches[2] != "", df_matches[5].where(df_matches[4] != "", df_matches[6])))
+
+    df_used_columns = pd.DataFrame({ "table_name": table_name.str.upper().to_numpy(), "object_name": object_name.str.upper().to_numpy() }, index = df_matches.index.get_level_values(0))
+
+    return df_used_columns
+
+def get_used_column_arrays(queries, offset):
+    df_used_columns = get_used_columns(pd.Series(queries, index = pd.RangeIndex(offset, offset + len(queries))))
+    table_codes, table_names = pd.factorize(df_used_columns["table_name"])
+    object_codes, object_names = pd.factorize(df_used_columns["object_name"])
+
+    # Codes and the distinct names only, pickling a frame of repeated strings back would cost more than the parsing
+    return df_used_columns.index.to_numpy(np.int32), table_codes.astype(np.int32), table_names.to_numpy(object), object_codes.astype(np.int32), object_names.to_numpy(object)
+
+def get_parsing_workers(parsing_configuration):
+    workers = parsing_configuration.get("workers", 1)
+    return (os.cpu_count() or 1) if workers == "auto" else workers
+
+def get_used_columns_in_parallel(queries, parsing_configuration = None):
+    parsing_configuration = {} if parsing_configuration is None else parsing_configuration
+    workers = get_parsing_workers(parsing_configuration)
+    min_queries_per_shard = parsing_configuration.get("min_queries_per_shard", 5000)
+
+    # A pool only pays off once every worker gets enough queries to amortize its startup
+    number_of_shards = min(workers * 4, len(queries) // min_queries_per_shard)
+    if workers <= 1 or number_of_shards <= 1:
+        return get_used_columns(pd.Series(queries))
+
+    print_log("Parse queries with {workers} workers in {shards} shards".format(workers = workers, shards = number_of_shards))
+    bounds = np.linspace(0, len(queries), number_of_shards + 1).astype(int)
+    with ProcessPoolExecutor(max_workers = workers, mp_context = multiprocessing.get_context("spawn")) as executor:
+        shards = list(executor.map(get_used_column_arrays, [queries[start:end] for start, end in zip(bounds[:-1], bounds[1:])], bounds[:-1].tolist()))
+
+    # Shards come back in submission order, the result does not depend on which worker finished first
+    query_codes = np.concatenate([shard[0] for shard in shards]).astype(np.int64)
+    table_names = np.concatenate([np.append(table_names, np.nan)[table_codes] for _, table_codes, table_names, _, _ in shards])
+    object_names = np.concatenate([np.append(object_names, np.nan)[object_codes] for _, _, _, object_codes, object_names in shards])
+
+    return pd.DataFrame({ "table_name": table_names, "object_name": object_names }, index = query_codes)
+
+def get_text_hashes(queries):
+    return pd.util.hash_array(np.asarray(queries, dtype = object), categorize = False).view(np.int64)
+
+def open_parse_store():
+    df_store = open_cache("parsed_texts") if open_manifest("parsed_texts").get("version") == PARSE_STORE_VERSION else None
+    if df_store is None:
+        return pd.DataFrame({ column: pd.Series(dtype = np.int64 if column == "text_hash" else float if column == "last_used" else object) for column in PARSE_STORE_COLUMNS })
+
+    return df_store
+
+def save_parse_store(df_store, parsing_configuration, cache_configuration):
+    # Least recently used texts are dropped first
+    last_used = df_store.groupby("text_hash")["last_used"].max()
+    max_texts = parsing_configuration.get("store_max_texts", 1000000)
+    if len(last_used) > max_texts:
+        df_store = df_store[df_store["text_hash"].isin(last_used.nlargest(max_texts).index)]
+
+    save_cache(df_store.reset_index(drop = True), "parsed_texts", cache_configuration)
+    save_manifest({ "version": PARSE_STORE_VERSION, "texts": min(len(last_used), max_texts) }, "parsed_texts", cache_configuration)
+
+def get_used_columns_from_store(queries, parsing_configuration, cache_configuration):
+    text_hashes = get_text_hashes(queries)
+
+    with parse_store_lock:
+        df_store = open_parse_store()
+        known = np.isin(text_hashes, df_store["text_hash"].to_numpy())
+        new_positions = np.flatnonzero(~known)
+        print_log("{known} of {total} distinct queries found in the parse store".format(known = int(known.sum()), total = len(queries)))
+
+        df_new = get_used_columns_in_parallel(queries[new_positions], parsing_configuration)
+        df_new.index = new_positions[df_new.index]
+
+        # Texts without any reference are stored with empty names, so they are not parsed again either
+        df_new_store = pd.DataFrame({ "text_hash": text_hashes[df_new.index], "table_name": df_new["table_name"].to_numpy(object), "object_name": df_new["object_name"].to_numpy(object) })
+        df_empty_store = pd.DataFrame({ "text_hash": text_hashes[np.setdiff1d(new_positions, df_new.index)], "table_name": None, "object_name": None })
+
+        df_positions = pd.DataFrame({ "text_hash": text_hashes, "query_code": np.arange(len(text_hashes)) })
+        df_known = df_store[df_store["object_name"].notnull()].merge(df_positions[known], on = "text_hash", how = "inner")
+        df_known = pd.DataFrame({ "table_name": df_known["table_name"].to_numpy(object), "object_name": df_known["object_name"].to_numpy(object) }, index = df_known["query_code"].to_numpy())
+
+        df_store.loc[df_store["text_hash"].isin(text_hashes), "last_used"] = time.time()
+        df_store = pd.concat([df_store, pd.concat([df_new_store, df_empty_store]).assign(last_used = time.time())], ignore_index = True)
+        save_parse_store(df_store, parsing_configuration, cache_configuration)
+
+    return pd.concat([df_known, df_new])
+
+def get_dependency_graph(df_dependencies):
+    graph = {}
+    columns = ["object_type", "table_name", "object_name", "referenced_object_type", "referenced_table", "referenced_object"]
+    for object_type, table_name, object_name, referenced_object_type, referenced_table, referenced_object in df_dependencies[columns].itertuples(index = False, name = None):
+        graph.setdefault((object_type, table_name, object_name), set()).add((referenced_object_type, referenced_table, referenced_object))
+
+    return graph
+
+def get_strongly_connected_components(graph):
+    # Iterative Tarjan: components are emitted after every component they depend on
+    index = {}
+    low = {}
+    stack = []
+    on_stack = set()
+    components = []
+    counter = 0
+
+    for root in graph:
+        if root in index:
+            continue
+
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(graph.get(root, ())))]
+
+        while work:
+            node, successors = work[-1]
+            visit = None
+            for successor in successors:
+                if successor not in index:
+                    visit = successor
+                    break
+                if successor in on_stack:
+                    low[node] = min(low[node], index[successor])
+
+            if visit is not None:
+                index[visit] = low[visit] = counter
+                counter += 1
+                stack.append(visit)
+                on_stack.add(visit)
+                work.append((visit, iter(graph.get(visit, ()))))
+                continue
+
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                low[parent] = min(low[parent], low[node])
+
+            if low[node] == index[node]:
+                component = set()
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.add(member)
+                    if member == node:
+                        break
+                components.append(component)
+
+    return components
+
+def get_transitive_closure(graph):
+    components = get_strongly_connected_components(graph)
+    component_of = { member: position for position, component in enumerate(components) for member in component }
+
+    cycles = []
+    reachable = []
+    for position, component in enumerate(components):
+        is_cycle = len(component) > 1 or any(member in graph.get(member, ()) for member in component)
+        reach = set(component) if is_cycle else set()
+        if is_cycle:
+            cycles.append(component)
+
+        for member in component:
+            for successor in graph.get(member, ()):
+                successor_position = component_of[successor]
+                if successor_position != position:
+                    reach |= components[successor_position]
+                    reach |= reachable[successor_position]
+
+        reachable.append(reach)
+
+    closure = { node: reachable[component_of[node]] - {node} for node in graph }
+
+    return closure, cycles
+
+def get_transitive_dependencies(df_dependencies):
+    rows = []
+    for (workspace_server, dataset_database), df_dataset in df_dependencies.groupby(["workspace_server", "dataset_database"], sort = False):
+        closure, cycles = get_transitive_closure(get_dependency_graph(df_dataset))
+
+        for cycle in cycles:
+            objects = ", ".join(sorted("{0}[{1}]".format(table_name, object_name) for _, table_name, object_name in cycle))
+            print_log("Circular dependency in dataset '{workspace}/{dataset}': {objects}".format(workspace = workspace_server, dataset = dataset_database, objects = objects), 30)
 
-    df_objects["object_name"] = df_objects["object_name"]
-    df_objects["table_name"] = df_objects["table_name"]
+        for (object_type, table_name, object_name), references in closure.items():
+            for referenced_object_type, referenced_table, referenced_object in references:
+                rows.append((workspace_server, dataset_database, object_type, table_name, object_name, referenced_object_type, referenced_table, referenced_object))
 
-    df_dependencies = df_objects[df_objects["query"].notnull()].copy()
-    df_dependencies["data"] = df_dependencies.apply(get_used_columns, axis = 1)
-    df_dependencies = df_dependencies.explode("data")
+    df_transitive_dependencies = pd.DataFrame(rows, columns = ["workspace_server", "dataset_database", "object_type", "table_name", "object_name", "referenced_object_type", "referenced_table", "referenced_object"])
+    df_transitive_dependencies = df_transitive_dependencies.sort_values(by = list(df_transitive_dependencies.columns)).reset_index(drop = True)
 
-    df_dependencies["referenced_table"] = df_dependencies.apply(get_table_name, axis = 1)
-    df_dependencies["referenced_object"] = df_dependencies.apply(get_object_name, axis = 1)
+    return df_transitive_dependencies
 
-    df_dependencies = df_dependencies.drop(["query", "table_id", "table_id", "object_id", "data"], axis = 1)
+def get_model_dependencies(df_objects):
+    print_log("Calculate direct dependencies")
+
+    df_dependencies = df_objects[df_objects["query"].notnull()].reset_index(drop = True)
+    df_used_columns = get_used_columns(df_dependencies["query"])
+    df_used_columns = df_used_columns.rename(columns = { "table_name" : "referenced_table", "object_name" : "referenced_object" })
+
+    df_dependencies = df_dependencies.drop(["query", "table_id", "object_id"], axis = 1).join(df_used_columns, how = "inner")
     df_objects = df_objects.drop(["query", "table_id", "object_id"], axis = 1)
 
     df_dependencies = pd.merge(df_dependencies, df_objects
@@ -68,103 +236,105 @@ def get_model_dependencies(df_objects):
                                                         , "object_name_x" : "object_name"
                                                         , "table_name_x" : "table_name" 
                                                         , "object_type_y" : "referenced_object_type" })
-    
-    df_dependencies = df_dependencies.drop(["object_name_y", "table_name_y"], axis = 1)
 
-    df_missing_dependencies = pd.merge(df_objects, df_dependencies
-                       , left_on = ["workspace_server", "dataset_database", "object_name", "table_name"]
-                       , right_on = ["workspace_server", "dataset_database", "object_name", "table_name"]
-                       , how = "left")
-    df_missing_dependencies = df_missing_dependencies[df_missing_dependencies["referenced_table"].isnull()]
-    df_missing_dependencies = df_missing_dependencies.rename(columns = { "object_type_x" : "object_type" })
-    df_missing_dependencies = df_missing_dependencies.drop(["object_type_y", "referenced_table", "referenced_object", "referenced_object_type"], axis = 1)
+    df_dependencies = df_dependencies[df_dependencies["referenced_object_type"].notnull()]
 
-    df_dependencies = pd.concat([df_dependencies, df_missing_dependencies]).drop_duplicates().reset_index(drop = True)
- 
     print_log("Analyse of sub dependencies")
-    deep_analysis = True
-    dept_level = 1
-    while deep_analysis:
-        print_log("Dept level {dept_level}".format(dept_level = dept_level))
-
-        deep_analysis = False
-        df_dependencies_to_add = None
-        for index in df_dependencies.index:
-            workspace_server = df_dependencies["workspace_server"][index]
-            dataset_database = df_dependencies["dataset_database"][index]
-
-            referenced_object_type = df_dependencies["referenced_object_type"][index]
-            referenced_table = df_dependencies["referenced_table"][index]
-            referenced_object = df_dependencies["referenced_object"][index]
-
-            object_type = df_dependencies["object_type"][index]
-            table_name = df_dependencies["table_name"][index]
-            object_name = df_dependencies["object_name"][index]
-
-            df_sub_dependencies = df_dependencies[(df_dependencies["workspace_server"] == workspace_server)
-                            & (df_dependencies["dataset_database"] == dataset_database)
-                            & (df_dependencies["object_type"] == referenced_object_type)
-                            & (df_dependencies["table_name"] == referenced_table)
-                            & (df_dependencies["object_name"] == referenced_object)
-                            ].copy()
-            
-            if len(df_sub_dependencies) == 0:
-                continue
+    df_dependencies = get_transitive_dependencies(df_dependencies)
 
-            df_sub_dependencies = df_sub_dependencies.drop_duplicates()
+    return df_dependencies
 
-            df_sub_dependencies["object_type"] = object_type
-            df_sub_dependencies["table_name"] = table_name
-            df_sub_dependencies["object_name"] = object_name
 
-            count_with_add = len(pd.concat([df_sub_dependencies, df_dependencies]).drop_duplicates())
-            count_without_add = len(df_dependencies)
+def get_query_usage(df_raw_queries, parsing_configuration = None, cache_configuration = None):
+    query_codes, queries = pd.factorize(df_raw_queries["query"])
+    print_log("Parse {distinct} distinct queries out of {total}".format(distinct = len(queries), total = len(df_raw_queries)))
 
-            if count_with_add > count_without_add:
-                if(df_dependencies_to_add is None):
-                    df_dependencies_to_add = df_sub_dependencies
-                else:
-                    df_dependencies_to_add = pd.concat([df_dependencies_to_add, df_sub_dependencies]).drop_duplicates().reset_index(drop = True)
+    parsing_configuration = {} if parsing_configuration is None else parsing_configuration
+    if cache_configuration is not None and cache_configuration["enabled"] and parsing_configuration.get("store", True):
+        df_used_columns = get_used_columns_from_store(queries, parsing_configuration, cache_configuration)
+    else:
+        df_used_columns = get_used_columns_in_parallel(queries, parsing_configuration)
+    df_used_columns = df_used_columns.groupby([df_used_columns.index.rename("query_code"), "table_name", "object_name"]).size().reset_index(name = "count_reference")
 
-        if df_dependencies_to_add is not None:
-            deep_analysis = True
-            df_dependencies = pd.concat([df_dependencies, df_dependencies_to_add]).drop_duplicates().reset_index(drop = True)
+    df_working = df_raw_queries[["workspace_server", "dataset_database", "date_key", "count"]].copy()
+    df_working["query_code"] = query_codes
+    df_working = df_working.groupby(["workspace_server", "dataset_database", "date_key", "query_code"], as_index = False)["count"].sum()
 
-        dept_level += 1
+    df_working = pd.merge(df_working, df_used_columns, on = "query_code", how = "inner")
+    df_working["count_call"] = df_working["count"] * df_working["count_reference"]
 
-        df_dependencies = df_dependencies[df_dependencies["referenced_object_type"].notnull()]
-    
-    df_dependencies = df_dependencies.drop(["table_name_raw_x", "object_name_raw_x", "table_name_raw_y", "object_name_raw_y", "table_name_raw", "object_name_raw"], axis = 1)
-    return df_dependencies
+    df_query_usage = df_working.groupby(["workspace_server", "dataset_database", "date_key", "table_name", "object_name"], as_index = False).agg(count_query = ("count", "sum"), count_call = ("count_call", "sum"))
 
+    return df_query_usage
 
-def get_parsed_queries(df_raw_queries, df_objects):
-    df_raw_queries["data"] = df_raw_queries.apply(get_used_columns, axis = 1)
-    df_working = df_raw_queries
+def merge_query_usage(partial_query_usage):
+    df_query_usage = pd.concat(partial_query_usage, ignore_index = True)
+    df_query_usage = df_query_usage.groupby(["workspace_server", "dataset_database", "date_key", "table_name", "object_name"], as_index = False)[["count_query", "count_call"]].sum()
 
-    df_working["query_id"] = pd.RangeIndex(stop = df_working.shape[0])
-    
-    df_working = df_working.explode("data")
+    return df_query_usage
 
-    df_working["table_name"] = df_working.apply(get_table_name, axis = 1)
-    df_working["object_name"] = df_working.apply(get_object_name, axis = 1)
+def get_date_revisions():
+    partitions_by_date = {}
+    for partition, state in open_manifest("queries_raw").get("partitions", {}).items():
+        partitions_by_date.setdefault(partition[:10], []).append("{partition}@{fetched_at}".format(partition = partition, fetched_at = state["fetched_at"]))
 
-    df_working = df_working.drop(["query", "data"], axis = 1)
+    return { date_key: hashlib.md5(",".join(sorted(partitions)).encode()).hexdigest() for date_key, partitions in partitions_by_date.items() }
 
-    df_query_level = df_working.drop_duplicates(["workspace_server", "dataset_database", "date_key", "table_name", "object_name", "query_id", "count"]).groupby(["workspace_server", "dataset_database", "date_key", "table_name", "object_name"], as_index = False).sum("count")
-    df_query_level = df_query_level.rename(columns = {'count': 'count_query'})
+def get_incremental_query_usage(df_raw_queries, cache_configuration, parsing_configuration = None):
+    date_revisions = get_date_revisions()
+    if len(date_revisions) == 0 or "partition" not in df_raw_queries.columns:
+        return get_query_usage(df_raw_queries, parsing_configuration, cache_configuration)
 
-    df_working = df_working.drop(["query_id"], axis = 1)
+    previous_revisions = {}
+    df_query_usage = []
+    df_previous_usage = open_cache("queries_usage")
+    if df_previous_usage is not None:
+        previous_revisions = open_manifest("queries_usage").get("dates", {})
+        kept_dates = [date_key for date_key, revision in date_revisions.items() if previous_revisions.get(date_key) == revision]
+        df_query_usage.append(df_previous_usage[df_previous_usage["date_key"].isin(kept_dates)])
     
-    df_column_level = df_working.groupby(["workspace_server", "dataset_database", "date_key", "table_name", "object_name"], as_index=  False)["count"].sum()
-    df_column_level = df_column_level.rename(columns = {'count': 'count_call'})
+    stale_dates = [date_key for date_key, revision in date_revisions.items() if previous_revisions.get(date_key) != revision]
+    print_log("Incremental mode: {count} of {total} dates to parse".format(count = len(stale_dates), total = len(date_revisions)))
+
+    df_stale_queries = df_raw_queries[df_raw_queries["date_key"].isin(stale_dates)]
+    if len(df_stale_queries) > 0:
+        df_query_usage.append(get_query_usage(df_stale_queries, parsing_configuration, cache_configuration))
+
+    df_query_usage = pd.concat(df_query_usage, ignore_index = True)
+
+    save_cache(df_query_usage, "queries_usage", cache_configuration)
+    save_manifest({ "dates": date_revisions }, "queries_usage", cache_configuration)
+
+    return df_query_usage
+
+def get_parsed_queries(df_raw_queries, df_objects, configuration = None):
+    parsing_configuration = None if configuration is None else configuration.get("parsing", {})
+    if configuration is not None and configuration["log_analytics"].get("incremental", False):
+        df_parsed_queries = get_incremental_query_usage(df_raw_queries, configuration["cache"], parsing_configuration)
+    else:
+        df_parsed_queries = get_query_usage(df_raw_queries, parsing_configuration, None if configuration is None else configuration.get("cache"))
 
-    df_parsed_queries = pd.merge(df_query_level, df_column_level, on = ["workspace_server", "dataset_database", "date_key", "table_name", "object_name"], how = 'inner')
-    
     df_parsed_queries = set_missing_tables(df_parsed_queries, df_objects)
 
     return df_parsed_queries
 
+def get_parsed_query_usage(df_query_usage, df_objects):
+    return set_missing_tables(df_query_usage, df_objects)
+
+
+def get_identifiers(df_objects):
+    df_identifiers = df_objects.drop(["query", "table_id", "object_id"], axis = 1, errors = "ignore")
+
+    # Dense ids, so that the usage grid joins and groups on integers instead of four strings
+    object_code = df_identifiers.groupby(IDENTIFIER_COLUMNS, sort = False, dropna = False).ngroup().astype(np.int32)
+
+    return df_identifiers.assign(object_code = object_code)
+
+def set_object_codes(df, df_identifiers, columns = IDENTIFIER_COLUMNS, code_column = "object_code"):
+    df_codes = df_identifiers[IDENTIFIER_COLUMNS + ["object_code"]].drop_duplicates()
+    df_codes.columns = columns + [code_column]
+
+    return pd.merge(df, df_codes, on = columns, how = "inner")
 
 def set_missing_tables(df_parsed_queries, df_objects):
     df_with_object = pd.merge(df_parsed_queries[df_parsed_queries["table_name"].notnull()], df_objects, on = ["workspace_server", "dataset_database", "table_name", "object_name"], how = "inner")
@@ -0,0 +1,139 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import time
+from types import SimpleNamespace
+
+DATA_SOURCE_MODES = ["live", "record", "replay"]
+# Values of the LogsQueryStatus string enum, replayed responses compare equal to it without loading the Azure SDK
+LOGS_QUERY_STATUSES = { "SUCCESS": "Success", "PARTIAL": "PartialError", "FAILURE": "Failure" }
+
+data_source_configuration = { "mode": "live", "directory": "recordings", "latency": 0 }
+
+def configure_data_source(configuration):
+    data_source_configuration.update(configuration)
+    if data_source_configuration["mode"] not in DATA_SOURCE_MODES:
+        raise ValueError("Unknown data source mode '{mode}', expected one of {modes}".format(mode = data_source_configuration["mode"], modes = ", ".join(DATA_SOURCE_MODES)))
+
+def get_data_source_mode():
+    return data_source_configuration["mode"]
+
+def get_recording_key(*values):
+    return hashlib.md5("\n".join(values).encode()).hexdigest()
+
+def get_recording_path(source, key):
+    return "{directory}/{source}/{key}.json.gz".format(directory = data_source_configuration["directory"], source = source, key = key)
+
+def save_recording(source, key, recording):
+    path = get_recording_path(source, key)
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+
+    temporary_path = "{path}.tmp".format(path = path)
+    with gzip.open(temporary_path, "wt") as f:
+        json.dump(recording, f, default = str)
+    os.replace(temporary_path, path)
+
+def open_recording(source, key):
+    path = get_recording_path(source, key)
+    if not os.path.isfile(path):
+        raise FileNotFoundError("No recorded response in '{path}', run once with the record data source".format(path = path))
+
+    with gzip.open(path, "rt") as f:
+        recording = json.load(f)
+
+    latency = data_source_configuration["latency"]
+    if latency == "recorded":
+        time.sleep(recording["duration"])
+    elif latency:
+        time.sleep(latency)
+
+    return recording
+
+# Azure Log Analytics
+class RecordingLogsQueryClient:
+    def __init__(self, client):
+        self.client = client
+
+    def query_workspace(self, workspace_id, query, timespan):
+        start_time = time.perf_counter()
+        response = self.client.query_workspace(workspace_id = workspace_id, query = query, timespan = timespan)
+        duration = time.perf_counter() - start_time
+
+        tables = response.partial_data if response.status == LOGS_QUERY_STATUSES["PARTIAL"] else response.tables
+        save_recording("log_analytics", get_recording_key(workspace_id, query), {
+            "query": query,
+            "status": response.status.name,
+            "partial_error": str(getattr(response, "partial_error", None)),
+            "tables": [{ "columns": list(table.columns), "rows": [list(row) for row in table.rows] } for table in tables],
+            "duration": duration
+        })
+
+        return response
+
+class ReplayLogsQueryClient:
+    def query_workspace(self, workspace_id, query, timespan):
+        recording = open_recording("log_analytics", get_recording_key(workspace_id, query))
+        tables = [SimpleNamespace(columns = table["columns"], rows = table["rows"]) for table in recording["tables"]]
+
+        if recording["status"] == "PARTIAL":
+            return SimpleNamespace(status = LOGS_QUERY_STATUSES["PARTIAL"], partial_data = tables, partial_error = recording["partial_error"])
+
+        return SimpleNamespace(status = LOGS_QUERY_STATUSES["SUCCESS"], tables = tables)
+
+# DMV, the secret is left out of the recording keys
+def get_connection_key(connection_string):
+    return re.sub("Password=[^;]*", "", connection_string)
+
+class RecordingCursor:
+    def __init__(self, connection_string, cursor):
+        self.connection_string = connection_string
+        self.cursor = cursor
+        self.rows = []
+
+    def execute(self, query):
+        start_time = time.perf_counter()
+        self.rows = [list(row) for row in self.cursor.execute(query).fetchone()]
+        duration = time.perf_counter() - start_time
+
+        save_recording("dmv", get_recording_key(get_connection_key(self.connection_string), query), { "query": query, "rows": self.rows, "duration": duration })
+        return self
+
+    def fetchone(self):
+        for row in self.rows:
+            yield row
+
+class RecordingConnection:
+    def __init__(self, connection, connection_string):
+        self.connection = connection
+        self.connection_string = connection_string
+
+    def cursor(self):
+        return RecordingCursor(self.connection_string, self.connection.cursor())
+
+    def close(self):
+        self.connection.close()
+
+class ReplayCursor:
+    def __init__(self, connection_string):
+        self.connection_string = connection_string
+        self.rows = []
+
+    def execute(self, query):
+        self.rows = open_recording("dmv", get_recording_key(get_connection_key(self.connection_string), query))["rows"]
+        return self
+
+    def fetchone(self):
+        for row in self.rows:
+            yield row
+
+class ReplayConnection:
+    def __init__(self, connection_string):
+        self.connection_string = connection_string
+
+    def cursor(self):
+        return ReplayCursor(self.connection_string)
+
+    def close(self):
+        pass
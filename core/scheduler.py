@@ -0,0 +1,117 @@
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import pandas as pd
+
+from core.cache import get_cache_entry, open_cache
+from core.metrics import execute_in_worker, stage_metrics
+from core.miscellaneous import print_log, process_or_get_from_cache
+
+STEPS = ["ingest", "parse", "export"]
+
+def get_stage_graph(stages, context):
+    outputs = {}
+    for stage in stages:
+        if stage["output"] in outputs or stage["output"] in context:
+            raise ValueError("Output '{output}' of stage '{name}' is already defined".format(output = stage["output"], name = stage["name"]))
+        outputs[stage["output"]] = stage["name"]
+
+    graph = {}
+    for stage in stages:
+        for input_name in stage["inputs"]:
+            if input_name not in outputs and input_name not in context:
+                raise ValueError("Input '{input}' of stage '{name}' is not produced by any stage".format(input = input_name, name = stage["name"]))
+        graph[stage["name"]] = [outputs[input_name] for input_name in stage["inputs"] if input_name in outputs]
+
+    return graph
+
+def get_stage_levels(stages, context):
+    graph = get_stage_graph(stages, context)
+
+    levels = {}
+    while len(levels) < len(graph):
+        ready = [name for name, upstreams in graph.items() if name not in levels and all(upstream in levels for upstream in upstreams)]
+        if len(ready) == 0:
+            raise ValueError("Stages {names} have circular dependencies".format(names = sorted(set(graph) - set(levels))))
+        for name in ready:
+            levels[name] = max([levels[upstream] + 1 for upstream in graph[name]], default = 0)
+
+    return levels
+
+def select_stages(stages, first_step = None, last_step = None):
+    first_index = 0 if first_step is None else STEPS.index(first_step)
+    last_index = len(STEPS) - 1 if last_step is None else STEPS.index(last_step)
+    if first_index > last_index:
+        raise ValueError("Step '{first}' comes after step '{last}'".format(first = first_step, last = last_step))
+
+    return [stage for stage in stages if first_index <= STEPS.index(stage["step"]) <= last_index]
+
+def open_skipped_outputs(stages, selected_stages):
+    selected_names = [stage["name"] for stage in selected_stages]
+    selected_inputs = set(input_name for stage in selected_stages for input_name in stage["inputs"])
+
+    # Stages left out of the run hand their output over from their last cache
+    outputs = {}
+    for stage in stages:
+        if stage["name"] in selected_names or stage["output"] not in selected_inputs:
+            continue
+        print_log("Get '{output}' from the cache of stage '{name}'".format(output = stage["output"], name = stage["name"]))
+        df_output = open_cache(stage["name"])
+        if df_output is None:
+            raise ValueError("Stage '{name}' is not selected and has no cache, run its step first".format(name = stage["name"]))
+        cache_entry = get_cache_entry(stage["name"])
+        if cache_entry is not None:
+            df_output.attrs["fingerprint"] = cache_entry["fingerprint"]
+        outputs[stage["output"]] = df_output
+
+    return outputs
+
+def execute_stage(stage, args, cache_configuration, executor, concurrent):
+    print_log(stage["description"])
+    if stage.get("cache_parameter") is not None:
+        period = stage["period"](**args) if "period" in stage else None
+        return process_or_get_from_cache(stage["function"], cache_configuration, stage["name"], stage["cache_parameter"], executor = executor, concurrent = concurrent, settings = stage.get("settings"), period = period, **args)
+
+    with stage_metrics(stage["name"], concurrent = concurrent, in_worker = executor is not None, **args) as metrics:
+        output = stage["function"](**args) if executor is None else execute_in_worker(stage["function"], stage["name"], executor, metrics, args)
+        if isinstance(output, pd.DataFrame):
+            metrics["output_rows"] = len(output)
+        elif isinstance(output, int):
+            metrics["output_rows"] = output
+    return output
+
+def run_stages(stages, context, cache_configuration, scheduler_configuration = None):
+    scheduler_configuration = {} if scheduler_configuration is None else scheduler_configuration
+    parallelism = scheduler_configuration.get("parallelism", 1)
+    use_processes = scheduler_configuration.get("use_processes", False) and any(stage["executor"] == "process" for stage in stages)
+
+    # Validates the declared inputs and outputs before anything runs
+    get_stage_levels(stages, context)
+
+    context = dict(context)
+    pending = list(stages)
+    running = {}
+    thread_pool = ThreadPoolExecutor(max_workers = parallelism)
+    # Forking while stages run on threads could copy held locks into the workers
+    process_pool = ProcessPoolExecutor(max_workers = parallelism, mp_context = multiprocessing.get_context("spawn")) if use_processes else None
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            # Stages are started in declaration order, so a parallelism of 1 keeps the sequential order
+            for stage in [stage for stage in pending if all(input_name in context for input_name in stage["inputs"])]:
+                if len(running) >= parallelism:
+                    break
+
+                executor = process_pool if stage["executor"] == "process" else None
+                args = { input_name: context[input_name] for input_name in stage["inputs"] }
+                running[thread_pool.submit(execute_stage, stage, args, cache_configuration, executor, parallelism > 1)] = stage
+                pending.remove(stage)
+
+            done, _ = wait(running, return_when = FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                context[stage["output"]] = future.result()
+    finally:
+        thread_pool.shutdown(wait = True, cancel_futures = True)
+        if process_pool is not None:
+            process_pool.shutdown(wait = True, cancel_futures = True)
+
+    return context
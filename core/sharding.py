@@ -0,0 +1,245 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+import pandas as pd
+
+from core import metrics
+from core.recording import configure_data_source
+from core.cache import get_fingerprint, get_frame_fingerprint, get_stage_settings, open_manifest, save_cache, save_cache_entry, save_manifest
+from core.export import export_output, export_output_chunks, get_output_path, get_partition_manifest_path, get_partition_path, open_partition_manifest, save_storage_history
+from core.miscellaneous import print_log
+from core.scheduler import open_skipped_outputs, run_stages
+
+SHARD_KEYS = { "workspace": ["workspace_server"], "dataset": ["workspace_server", "dataset_database"] }
+# Outputs computed once for the whole scope and split between the shards
+SHARED_OUTPUTS = ["df_scope", "df_raw_queries", "df_query_usage"]
+SHARDED_EXPORTS = ["storage", "usage_by_objects"]
+
+def get_shards_directory(sharding_configuration):
+    return sharding_configuration.get("directory", "shards")
+
+def get_shard_directory(sharding_configuration, shard_id):
+    return "{directory}/shard_{shard_id:03d}".format(directory = get_shards_directory(sharding_configuration), shard_id = shard_id)
+
+def get_shard_manifest_path(sharding_configuration):
+    return "{directory}/manifest.json".format(directory = get_shards_directory(sharding_configuration))
+
+def get_shard_status_path(shard_directory):
+    return "{directory}/status.json".format(directory = shard_directory)
+
+def open_shard_manifest(sharding_configuration):
+    file_path = get_shard_manifest_path(sharding_configuration)
+    if not os.path.isfile(file_path):
+        raise FileNotFoundError("No shard manifest in '{path}', plan the shards first".format(path = file_path))
+
+    with open(file_path) as f:
+        return json.load(f)
+
+def open_shard_status(shard_directory):
+    file_path = get_shard_status_path(shard_directory)
+    if not os.path.isfile(file_path):
+        return {}
+
+    with open(file_path) as f:
+        return json.load(f)
+
+def save_shard_status(shard_directory, status, fingerprint, error = None, date_keys = None):
+    with open(get_shard_status_path(shard_directory), "w") as f:
+        json.dump({ "status": status, "fingerprint": fingerprint, "error": error, "date_keys": date_keys, "updated_at": datetime.now(timezone.utc).isoformat() }, f, indent = 2, sort_keys = True)
+
+def shard_is_done(shard):
+    status = open_shard_status(shard["directory"])
+    return status.get("status") == "done" and status.get("fingerprint") == shard["fingerprint"]
+
+def get_shard_ids(df, key, count):
+    # md5 rather than hash() so that every machine assigns a dataset to the same shard
+    values = df[SHARD_KEYS[key]].astype(str).agg("\n".join, axis = 1)
+    return values.map(lambda value: int(hashlib.md5(value.encode()).hexdigest(), 16) % count).to_numpy()
+
+def get_shared_stages(stages):
+    return [stage for stage in stages if stage["output"] in SHARED_OUTPUTS]
+
+def get_shard_stages(stages):
+    return [stage for stage in stages if stage["output"] not in SHARED_OUTPUTS]
+
+def plan_shards(stages, context, cache_configuration, scheduler_configuration, sharding_configuration):
+    key = sharding_configuration.get("key", "workspace")
+    count = sharding_configuration.get("count", os.cpu_count() or 1)
+    if key not in SHARD_KEYS:
+        raise ValueError("Unknown shard key '{key}', expected one of {keys}".format(key = key, keys = ", ".join(SHARD_KEYS)))
+
+    shared_stages = get_shared_stages(stages)
+    context = run_stages(shared_stages, context, cache_configuration, scheduler_configuration)
+    queries_manifest = open_manifest("queries_raw")
+
+    df_scope = context["df_scope"]
+    scope_shard_ids = get_shard_ids(df_scope, key, count)
+
+    # Rows of the shared inputs follow their dataset, rows outside of the scope are left out
+    df_dataset_shards = df_scope[SHARD_KEYS["dataset"]].assign(shard_id = scope_shard_ids).drop_duplicates(SHARD_KEYS["dataset"])
+    shard_ids = { stage["output"]: scope_shard_ids if stage["output"] == "df_scope" else context[stage["output"]][SHARD_KEYS["dataset"]].merge(df_dataset_shards, on = SHARD_KEYS["dataset"], how = "left")["shard_id"].to_numpy() for stage in shared_stages }
+
+    # Every shard audits the dates of the whole scope, a shard without any query still exports its objects on each date
+    date_keys = pd.concat([context[stage["output"]]["date_key"] for stage in shared_stages if stage["output"] != "df_scope"])
+    date_range = None if len(date_keys) == 0 else [date_keys.min(), date_keys.max()]
+
+    # A finished shard runs again when the settings of its stages change, and every day while the storage is a daily snapshot
+    run_fingerprints = [get_fingerprint(get_stage_settings(context, sorted(set(setting for stage in stages for setting in stage.get("settings", [])))))]
+    if context["output_configuration"].get("storage_mode", "snapshot") != "history":
+        run_fingerprints.append(datetime.now().strftime("%Y-%m-%d"))
+
+    shards = []
+    for shard_id in sorted(set(scope_shard_ids)):
+        shard_directory = get_shard_directory(sharding_configuration, shard_id)
+        for directory in ["cache", "output"]:
+            os.makedirs("{shard}/{directory}".format(shard = shard_directory, directory = directory), exist_ok = True)
+
+        shard_datasets = len(df_dataset_shards[df_dataset_shards["shard_id"] == shard_id])
+
+        # The shard inputs are written as the cache of the shared stages, the shard run reads them back as skipped stages
+        fingerprints = run_fingerprints + [str(date_range)]
+        working_directory = os.getcwd()
+        os.chdir(shard_directory)
+        try:
+            for stage in shared_stages:
+                df_input = context[stage["output"]][shard_ids[stage["output"]] == shard_id].reset_index(drop = True)
+                fingerprint = get_frame_fingerprint(df_input)
+                save_cache(df_input, stage["name"], dict(cache_configuration, enabled = True))
+                save_cache_entry(stage["name"], None, fingerprint, dict(cache_configuration, enabled = True))
+                fingerprints.append(fingerprint)
+
+            # Keeps the incremental parsing of the shard in line with the fetched partitions
+            save_manifest(queries_manifest, "queries_raw", dict(cache_configuration, enabled = True))
+        finally:
+            os.chdir(working_directory)
+
+        shards.append({ "id": int(shard_id), "directory": shard_directory, "datasets": shard_datasets, "date_range": date_range, "fingerprint": hashlib.md5(",".join(fingerprints).encode()).hexdigest() })
+
+    manifest = { "key": key, "count": count, "created_at": datetime.now(timezone.utc).isoformat(), "shards": shards }
+    with open(get_shard_manifest_path(sharding_configuration), "w") as f:
+        json.dump(manifest, f, indent = 2, sort_keys = True)
+
+    print_log("{shards} shards planned by {key} for {datasets} datasets".format(shards = len(shards), key = key, datasets = sum(shard["datasets"] for shard in shards)))
+
+    return manifest
+
+def run_shard(shard, stages, context, cache_configuration, scheduler_configuration):
+    working_directory = os.getcwd()
+    # The ADOMD client is looked up relative to the start directory
+    resources_directory = os.path.join(working_directory, "resources")
+    if resources_directory not in sys.path:
+        sys.path.append(resources_directory)
+
+    # Workers are spawned with the default settings of the modules
+    configuration = context["configuration"]
+    data_source_configuration = configuration.get("data_source", {})
+    metrics.configure_metrics(configuration.get("metrics", {}))
+    configure_data_source(dict(data_source_configuration, directory = os.path.join(working_directory, data_source_configuration.get("directory", "recordings"))))
+
+    print_log("Run shard {shard_id} on {datasets} datasets".format(shard_id = shard["id"], datasets = shard["datasets"]))
+    os.chdir(shard["directory"])
+    metrics.run_metrics.clear()
+    try:
+        # Partitions are merged date by date, whatever the layout of the final outputs
+        shard_stages = get_shard_stages(stages)
+        shard_context = dict(context, output_configuration = dict(context["output_configuration"], layout = "partitioned", date_range = shard["date_range"]))
+        shard_context.update(open_skipped_outputs(stages, shard_stages))
+
+        run_stages(shard_stages, shard_context, cache_configuration, scheduler_configuration)
+        metrics.save_run_metrics()
+        date_keys = { export_name: open_partition_manifest(export_name).get("exported_partitions", []) for export_name in SHARDED_EXPORTS }
+        save_shard_status(".", "done", shard["fingerprint"], date_keys = date_keys)
+    except Exception as err:
+        save_shard_status(".", "failed", shard["fingerprint"], str(err))
+        raise
+    finally:
+        os.chdir(working_directory)
+
+def run_shards(stages, context, cache_configuration, scheduler_configuration, sharding_configuration, shard_ids = None):
+    manifest = open_shard_manifest(sharding_configuration)
+    shards = [shard for shard in manifest["shards"] if (shard_ids is None and not shard_is_done(shard)) or (shard_ids is not None and shard["id"] in shard_ids)]
+    print_log("{count} of {total} shards to run".format(count = len(shards), total = len(manifest["shards"])))
+
+    failed = []
+    if len(shards) == 0:
+        return failed
+
+    workers = min(len(shards), sharding_configuration.get("workers", os.cpu_count() or 1))
+    with ProcessPoolExecutor(max_workers = workers, mp_context = multiprocessing.get_context("spawn")) as executor:
+        futures = { shard["id"]: executor.submit(run_shard, shard, stages, context, cache_configuration, scheduler_configuration) for shard in shards }
+        for shard_id, future in futures.items():
+            try:
+                future.result()
+            except Exception as err:
+                print_log("Shard {shard_id} failed: {error}".format(shard_id = shard_id, error = err), 40)
+                failed.append(shard_id)
+
+    return failed
+
+def open_shard_partitions(export_name, shard):
+    file_path = os.path.join(shard["directory"], get_partition_manifest_path(export_name))
+    if not os.path.isfile(file_path):
+        return {}
+
+    with open(file_path) as f:
+        return json.load(f)["partitions"]
+
+def get_shard_partition_chunks(export_name, shards, date_keys):
+    shard_manifests = [open_shard_partitions(export_name, shard) for shard in shards]
+
+    # One chunk per date with every shard, in the order of the object keys
+    for date_key in date_keys:
+        frames = []
+        for shard, partitions in zip(shards, shard_manifests):
+            if date_key not in partitions:
+                continue
+            partition_path = os.path.join(shard["directory"], get_partition_path(export_name, date_key, partitions[date_key]["format"]))
+            frames.append(pd.read_parquet(partition_path) if partitions[date_key]["format"] == "parquet" else pd.read_csv(partition_path))
+
+        # A date removed from every shard is removed from the merged output
+        if len(frames) == 0:
+            continue
+        yield pd.concat(frames, ignore_index = True).sort_values(by = "object_key", kind = "stable")
+
+def get_shard_date_keys(export_name, shards):
+    # Only the dates exported by the last run of each shard are merged again, shards run before their dates were recorded give all of theirs
+    date_keys = set()
+    for shard in shards:
+        exported_date_keys = (open_shard_status(shard["directory"]).get("date_keys") or {}).get(export_name)
+        date_keys.update(open_shard_partitions(export_name, shard) if exported_date_keys is None else exported_date_keys)
+
+    return sorted(date_keys)
+
+def open_shard_outputs(export_name, shards, **args):
+    frames = [pd.read_csv(os.path.join(shard["directory"], get_output_path(export_name)), **args) for shard in shards if os.path.isfile(os.path.join(shard["directory"], get_output_path(export_name)))]
+    return pd.concat(frames, ignore_index = True) if len(frames) > 0 else None
+
+def merge_shards(output_configuration, sharding_configuration):
+    manifest = open_shard_manifest(sharding_configuration)
+    pending = [shard["id"] for shard in manifest["shards"] if not shard_is_done(shard)]
+    if len(pending) > 0:
+        raise ValueError("Shards {shard_ids} are not done, run them before the merge".format(shard_ids = pending))
+
+    shards = sorted(manifest["shards"], key = lambda shard: shard["id"])
+    print_log("Merge {count} shards".format(count = len(shards)))
+
+    df_objects = open_shard_outputs("objects", shards)
+    if df_objects is not None:
+        export_output(df_objects.sort_values(by = "object_key", kind = "stable"), "objects", False)
+
+    if output_configuration.get("storage_mode", "snapshot") == "history":
+        df_history = open_shard_outputs("storage_history", shards, dtype = { "object_key": str, "valid_from": str, "valid_to": str })
+        if df_history is not None:
+            save_storage_history(df_history.sort_values(by = ["object_key", "valid_from"], kind = "stable").reset_index(drop = True))
+        export_names = ["usage_by_objects"]
+    else:
+        export_names = SHARDED_EXPORTS
+
+    for export_name in export_names:
+        date_keys = get_shard_date_keys(export_name, shards)
+        if len(date_keys) > 0:
+            export_output_chunks(get_shard_partition_chunks(export_name, shards, date_keys), export_name, date_keys, output_configuration)
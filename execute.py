@@ -1,53 +1,101 @@
+import argparse
 import yaml
 from sys import path
 
 path.append("resources")
 
-from core.miscellaneous import print_log, process_or_get_from_cache
-from core.ingestion import get_available_scope, get_log_analytics_raw_queries, get_model_objects, get_storage, set_auth_environment_variables
-from core.processing import get_model_dependencies, get_parsed_queries
-from core.export import export_output, get_output_storage, get_output_objects, get_output_usage_by_object
-
-with open("queries.yml") as f:
-    queries = yaml.load(f, Loader = yaml.loader.SafeLoader)
-
-with open("settings.yml") as f:
-    configuration = yaml.load(f, Loader = yaml.loader.SafeLoader)
-
-if configuration["mode"] != "aas":
-    configuration["mode"] = "power_bi"
-
-print_log("Start auditing")
-set_auth_environment_variables(configuration)
-
-print_log("Get raw queries from Azure Log Analytics")
-df_raw_queries = process_or_get_from_cache(get_log_analytics_raw_queries, configuration["cache"], "queries_raw", "use_raw_queries_cache", configuration = configuration, queries = queries)
-
-print_log("Get available scope")
-df_scope = process_or_get_from_cache(get_available_scope, configuration["cache"], "available_scope", "use_scope_cache", configuration = configuration, queries = queries)
-
-print_log("Get models objects")
-df_objects = process_or_get_from_cache(get_model_objects, configuration["cache"], "model_objects", "use_model_cache", configuration = configuration, queries = queries, df_scope = df_scope)
-
-print_log("Get storage information")
-df_storage =  process_or_get_from_cache(get_storage, configuration["cache"], "storage", "use_storage_cache", configuration = configuration, queries = queries, df_scope = df_scope, df_objects = df_objects)
-
-print_log("Calculate models dependencies")
-df_dependencies = process_or_get_from_cache(get_model_dependencies, configuration["cache"], "model_dependencies", "use_model_cache", df_objects = df_objects)
-
-print_log("Parse queries")
-df_parsed_queries = process_or_get_from_cache(get_parsed_queries, configuration["cache"], "queries_parsed", "use_parsed_queries_cache", df_raw_queries = df_raw_queries, df_objects = df_objects)
-
-print_log("Generate output datasets")
-print_log("Usage by object level")
-df_output_usage_by_object = get_output_usage_by_object(df_parsed_queries, df_objects, df_dependencies)
-
-print_log("Export results")
-df_output_objects = get_output_objects(df_objects)
-df_output_storage = get_output_storage(df_storage, df_parsed_queries)
-
-export_output(df_output_objects, "objects", False)
-export_output(df_output_storage, "storage", True)
-export_output(df_output_usage_by_object, "usage_by_objects", True)
-
-exit(0)
\ No newline at end of file
+from core.metrics import configure_metrics, get_run_metrics_summary, save_run_metrics
+from core.miscellaneous import print_log
+from core.recording import configure_data_source
+from core.scheduler import STEPS, open_skipped_outputs, run_stages, select_stages
+from core.sharding import merge_shards, plan_shards, run_shards
+from core.ingestion import get_available_scope, get_log_analytics_query_usage, get_log_analytics_raw_queries, get_model_objects, get_raw_queries_period, get_storage, set_auth_environment_variables
+from core.processing import get_model_dependencies, get_parsed_queries, get_parsed_query_usage
+from core.export import export_objects, export_storage, export_usage_by_objects
+
+# Settings changing the data returned by a stage, the others only tune the run and keep the cache of the stage
+LOG_ANALYTICS_SETTINGS = ["configuration.mode", "configuration.azure.tenant_id", "configuration.azure.application_id", "configuration.log_analytics.workspace_id", "queries.azure_log_analytics"]
+QUERIES_SETTINGS = LOG_ANALYTICS_SETTINGS + ["configuration.log_analytics.search_dept", "configuration.log_analytics.incremental", "configuration.log_analytics.ingestion_delay"]
+DMV_SETTINGS = ["configuration.mode", "configuration.azure.tenant_id", "configuration.azure.tenant_name", "configuration.azure.application_id", "queries.dmv"]
+
+def get_stages(streaming):
+    # Network bound stages run on threads, CPU bound stages on processes when scheduler.use_processes is set
+    if streaming:
+        query_stages = [
+            { "name": "queries_usage_streamed", "description": "Get queries usage from Azure Log Analytics, partition by partition", "function": get_log_analytics_query_usage, "inputs": ["configuration", "queries"], "output": "df_query_usage", "cache_parameter": "use_raw_queries_cache", "settings": QUERIES_SETTINGS, "executor": "thread", "step": "ingest" },
+            { "name": "queries_parsed", "description": "Parse queries", "function": get_parsed_query_usage, "inputs": ["df_query_usage", "df_objects"], "output": "df_parsed_queries", "cache_parameter": "use_parsed_queries_cache", "executor": "process", "step": "parse" },
+        ]
+    else:
+        query_stages = [
+            { "name": "queries_raw", "description": "Get raw queries from Azure Log Analytics", "function": get_log_analytics_raw_queries, "inputs": ["configuration", "queries"], "output": "df_raw_queries", "cache_parameter": "use_raw_queries_cache", "settings": QUERIES_SETTINGS, "period": get_raw_queries_period, "executor": "thread", "step": "ingest" },
+            { "name": "queries_parsed", "description": "Parse queries", "function": get_parsed_queries, "inputs": ["configuration", "df_raw_queries", "df_objects"], "output": "df_parsed_queries", "cache_parameter": "use_parsed_queries_cache", "settings": ["configuration.log_analytics.incremental"], "executor": "process", "step": "parse" },
+        ]
+
+    return query_stages[:1] + [
+        { "name": "available_scope", "description": "Get available scope", "function": get_available_scope, "inputs": ["configuration", "queries"], "output": "df_scope", "cache_parameter": "use_scope_cache", "settings": LOG_ANALYTICS_SETTINGS, "executor": "thread", "step": "ingest" },
+        { "name": "model_objects", "description": "Get models objects", "function": get_model_objects, "inputs": ["configuration", "queries", "df_scope"], "output": "df_objects", "cache_parameter": "use_model_cache", "settings": DMV_SETTINGS, "executor": "thread", "step": "ingest" },
+        { "name": "storage", "description": "Get storage information", "function": get_storage, "inputs": ["configuration", "queries", "df_scope", "df_objects"], "output": "df_storage", "cache_parameter": "use_storage_cache", "settings": DMV_SETTINGS, "executor": "thread", "step": "ingest" },
+        { "name": "model_dependencies", "description": "Calculate models dependencies", "function": get_model_dependencies, "inputs": ["df_objects"], "output": "df_dependencies", "cache_parameter": "use_model_cache", "executor": "process", "step": "parse" },
+    ] + query_stages[1:] + [
+        { "name": "export_objects", "description": "Export objects", "function": export_objects, "inputs": ["df_objects", "cache_configuration"], "output": "df_output_objects", "executor": "thread", "step": "export" },
+        { "name": "export_storage", "description": "Export storage", "function": export_storage, "inputs": ["df_storage", "df_parsed_queries", "output_configuration", "cache_configuration"], "output": "df_output_storage", "settings": ["output_configuration.storage_mode"], "executor": "thread", "step": "export" },
+        { "name": "export_usage_by_objects", "description": "Export usage by object level", "function": export_usage_by_objects, "inputs": ["df_parsed_queries", "df_objects", "df_dependencies", "output_configuration", "cache_configuration"], "output": "usage_by_objects_rows", "settings": ["output_configuration.usage_mode"], "executor": "process", "step": "export" },
+    ]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Audit the usage of the tabular models")
+    parser.add_argument("--from", dest = "first_step", choices = STEPS, help = "first step to run, the outputs of the previous steps are read from the cache")
+    parser.add_argument("--to", dest = "last_step", choices = STEPS, help = "last step to run")
+    parser.add_argument("--plan-shards", action = "store_true", help = "only write the shard manifest and the inputs of each shard")
+    parser.add_argument("--shard", type = int, action = "append", help = "only run this shard of the shard manifest, can be repeated")
+    parser.add_argument("--merge-shards", action = "store_true", help = "only merge the outputs of the shards")
+    arguments = parser.parse_args()
+    if arguments.first_step is not None and arguments.last_step is not None and STEPS.index(arguments.first_step) > STEPS.index(arguments.last_step):
+        parser.error("step '{first}' comes after step '{last}'".format(first = arguments.first_step, last = arguments.last_step))
+
+    with open("queries.yml") as f:
+        queries = yaml.load(f, Loader = yaml.loader.SafeLoader)
+
+    with open("settings.yml") as f:
+        configuration = yaml.load(f, Loader = yaml.loader.SafeLoader)
+
+    if configuration["mode"] != "aas":
+        configuration["mode"] = "power_bi"
+
+    configure_metrics(configuration.get("metrics", {}))
+    configure_data_source(configuration.get("data_source", {}))
+
+    print_log("Start auditing")
+    set_auth_environment_variables(configuration)
+
+    stages = get_stages(configuration["log_analytics"].get("streaming", False))
+    context = { "configuration": configuration, "queries": queries, "output_configuration": configuration.get("output", {}), "cache_configuration": configuration["cache"] }
+
+    sharding_configuration = configuration.get("sharding", {})
+    shard_steps = [arguments.plan_shards, arguments.shard is not None, arguments.merge_shards]
+    if sharding_configuration.get("enabled", False) or any(shard_steps):
+        if arguments.first_step is not None or arguments.last_step is not None:
+            parser.error("--from and --to can't be used with sharding")
+
+        # Without a shard argument the whole sharded run happens here: plan, run the pending shards, merge
+        run_all = not any(shard_steps)
+        if run_all or arguments.plan_shards:
+            plan_shards(stages, context, configuration["cache"], configuration.get("scheduler", {}), sharding_configuration)
+        if run_all or arguments.shard is not None:
+            failed_shards = run_shards(stages, context, configuration["cache"], configuration.get("scheduler", {}), sharding_configuration, arguments.shard)
+            if len(failed_shards) > 0:
+                print_log("Shards {shard_ids} failed, run them again with --shard before the merge".format(shard_ids = failed_shards), 50)
+                exit(1)
+        if run_all or arguments.merge_shards:
+            merge_shards(context["output_configuration"], sharding_configuration)
+    else:
+        selected_stages = select_stages(stages, arguments.first_step, arguments.last_step)
+        context.update(open_skipped_outputs(stages, selected_stages))
+        run_stages(selected_stages, context, configuration["cache"], configuration.get("scheduler", {}))
+
+    save_run_metrics()
+    print_log("Run summary")
+    for line in get_run_metrics_summary():
+        print_log(line)
+
+    exit(0)